@@ -0,0 +1,353 @@
+"""
+Open-loop load generator for the webshop. Requests are started at a target rate (whether or not earlier
+ones finished) following a weighted mix of operations, and throughput and latency percentiles are reported
+per operation, from the time each request was scheduled so that time spent waiting for a free slot counts.
+Afterwards it checks that no money or stock was created or lost: the credit of the benchmark users and the
+value of the benchmark stock each only change by what the benchmark added, minus the totals of the paid orders.
+
+    python -m benchmark.load --url http://127.0.0.1:8000 --rps 500 --duration 60
+    python -m benchmark.load --target celery --mix find_item=5,checkout=1
+
+With --target http requests go through nginx and the gateway. With --target celery the service tasks are
+sent directly (and checkouts run the gateway saga in process), which leaves out HTTP and the gateway.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+
+DEFAULT_MIX = "find_item=4,find_user=2,find_order=3,create_order=1,add_item=3,add_stock=1,add_funds=1,checkout=1"
+
+
+class HttpTarget():
+    """Operations as HTTP calls to the gateway, over a pooled keep-alive client."""
+
+    def __init__(self, url, connections):
+        import httpx
+
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        self.client = httpx.AsyncClient(base_url=url, limits=limits, timeout=70)
+
+    async def call(self, method, path, **kwargs):
+        response = await self.client.request(method, path, **kwargs)
+        if response.status_code >= 500:
+            raise RuntimeError(f"{method} {path}: {response.status_code}")
+        return response.json() if 200 <= response.status_code < 300 else None
+
+    async def create_users(self, n, credit):
+        return (await self.call("POST", f"/payment/create_users/{n}/{credit}"))["user_ids"]
+
+    async def create_items(self, items):
+        return (await self.call("POST", "/stock/items/create", json=items))["item_ids"]
+
+    async def find_item(self, item_id):
+        return await self.call("GET", f"/stock/find/{item_id}")
+
+    async def find_user(self, user_id):
+        return await self.call("GET", f"/payment/find_user/{user_id}")
+
+    async def find_order(self, order_id):
+        return await self.call("GET", f"/orders/find/{order_id}")
+
+    async def create_order(self, user_id):
+        order = await self.call("POST", f"/orders/create/{user_id}")
+        return order["order_id"] if order else None
+
+    async def add_item(self, order_id, item_id, price):
+        return await self.call("POST", f"/orders/addItem/{order_id}/{item_id}")
+
+    async def add_stock(self, item_id, amount):
+        return await self.call("POST", f"/stock/add/{item_id}/{amount}")
+
+    async def add_funds(self, user_id, amount):
+        return await self.call("POST", f"/payment/add_funds/{user_id}/{amount}")
+
+    async def checkout(self, order_id):
+        return await self.call("POST", f"/orders/checkout/{order_id}")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class CeleryTarget():
+    """Operations as tasks sent straight to the services."""
+
+    def __init__(self):
+        import order.tasks as orders
+        import payment.tasks as payment
+        import stock.tasks as stock
+        from gateway.app import checkout_order
+        from gateway.results import run
+
+        self.orders, self.payment, self.stock = orders, payment, stock
+        self.checkout_order = checkout_order
+        self.run = run
+
+    async def call(self, signature):
+        task, result = await self.run(signature)
+        return result
+
+    async def create_users(self, n, credit):
+        return (await self.call(self.payment.create_users.s(n, credit)))["user_ids"]
+
+    async def create_items(self, items):
+        return (await self.call(self.stock.create_items.s(items)))["item_ids"]
+
+    async def find_item(self, item_id):
+        return await self.call(self.stock.find_item.s(item_id))
+
+    async def find_user(self, user_id):
+        return await self.call(self.payment.find_user.s(user_id))
+
+    async def find_order(self, order_id):
+        return await self.call(self.orders.find_order.s(order_id))
+
+    async def create_order(self, user_id):
+        order = await self.call(self.orders.create_order.s(user_id))
+        return order["order_id"] if order else None
+
+    async def add_item(self, order_id, item_id, price):
+        return await self.call(self.orders.add_item.s(order_id, item_id, price))
+
+    async def add_stock(self, item_id, amount):
+        return await self.call(self.stock.add_stock.s(item_id, amount))
+
+    async def add_funds(self, user_id, amount):
+        return await self.call(self.payment.add_credit.s(user_id, amount))
+
+    async def checkout(self, order_id):
+        from fastapi import HTTPException
+
+        try:
+            return await self.checkout_order(order_id)
+        except HTTPException as e:
+            if e.status_code >= 500:
+                raise
+            return None
+
+    async def close(self):
+        pass
+
+
+class Workload():
+    """Benchmark dataset and the operations of the mix, each returning whether it succeeded."""
+
+    def __init__(self, target, users, items, initial_stock, initial_credit, max_price):
+        self.target = target
+        self.n_users = users
+        self.n_items = items
+        self.initial_stock = initial_stock
+        self.initial_credit = initial_credit
+        self.max_price = max_price
+
+        self.user_ids = []
+        self.prices = {}
+        self.orders = []
+        # Orders that were not checked out yet. Checked out orders are not changed anymore, so that the total
+        # cost they have at the end is what was paid, and an order is not changed while it is checked out.
+        self.open_orders = []
+        self.order_locks = defaultdict(asyncio.Lock)
+        # Credit and stock value added by the benchmark itself, accounted for in the consistency check
+        self.added_credit = 0
+        self.added_stock_value = 0
+        # Additions that failed with an error may still have been applied, which makes the check inconclusive
+        self.unknown_additions = 0
+
+    async def seed(self):
+        self.user_ids = await self.target.create_users(self.n_users, self.initial_credit)
+        items = [{"price": random.randint(1, self.max_price), "stock": self.initial_stock} for _ in range(self.n_items)]
+        item_ids = await self.target.create_items(items)
+        self.prices = {item_id: item["price"] for item_id, item in zip(item_ids, items)}
+        self.item_ids = item_ids
+        for _ in range(min(self.n_users, 100)):
+            await self.create_order()
+
+    async def totals(self):
+        """Credit of the benchmark users and value of the benchmark stock."""
+        users = await asyncio.gather(*[self.target.find_user(user_id) for user_id in self.user_ids])
+        items = await asyncio.gather(*[self.target.find_item(item_id) for item_id in self.item_ids])
+        return sum(user["credit"] for user in users), sum(item["stock"] * item["price"] for item in items)
+
+    async def paid_total(self):
+        """Total cost of the benchmark orders that are paid. A checkout takes it from both credit and stock value."""
+        orders = await asyncio.gather(*[self.target.find_order(order_id) for order_id in self.orders])
+        return sum(order["total_cost"] for order in orders if order and order["paid"])
+
+    async def find_item(self):
+        return await self.target.find_item(random.choice(self.item_ids)) is not None
+
+    async def find_user(self):
+        return await self.target.find_user(random.choice(self.user_ids)) is not None
+
+    async def find_order(self):
+        return await self.target.find_order(random.choice(self.orders)) is not None
+
+    async def create_order(self):
+        order_id = await self.target.create_order(random.choice(self.user_ids))
+        if order_id:
+            self.orders.append(order_id)
+            self.open_orders.append(order_id)
+        return order_id is not None
+
+    async def _open_order(self):
+        if not self.open_orders:
+            await self.create_order()
+        return random.choice(self.open_orders)
+
+    async def add_item(self):
+        item_id = random.choice(self.item_ids)
+        order_id = await self._open_order()
+        async with self.order_locks[order_id]:
+            if order_id not in self.open_orders:
+                return False
+            return await self.target.add_item(order_id, item_id, self.prices[item_id]) is not None
+
+    async def add_stock(self):
+        item_id = random.choice(self.item_ids)
+        self.unknown_additions += 1
+        result = await self.target.add_stock(item_id, 1)
+        self.unknown_additions -= 1
+        if result is not None:
+            self.added_stock_value += self.prices[item_id]
+            return True
+        return False
+
+    async def add_funds(self):
+        amount = random.randint(1, self.max_price)
+        self.unknown_additions += 1
+        result = await self.target.add_funds(random.choice(self.user_ids), amount)
+        self.unknown_additions -= 1
+        if result is not None:
+            self.added_credit += amount
+            return True
+        return False
+
+    async def checkout(self):
+        order_id = await self._open_order()
+        async with self.order_locks[order_id]:
+            if order_id not in self.open_orders:
+                return False
+            # Closed unless the checkout surely failed, an error may still have been paid
+            self.open_orders.remove(order_id)
+            result = await self.target.checkout(order_id)
+            if result is None:
+                self.open_orders.append(order_id)
+            return result is not None
+
+
+class Stats():
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def record(self, operation, duration, outcome):
+        self.latencies[operation].append(duration)
+        if outcome is None:
+            self.errors[operation] += 1
+        elif not outcome:
+            self.failures[operation] += 1
+
+    def report(self, elapsed):
+        print(f"{'operation':<14}{'count':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'failed':>8}{'errors':>8}")
+        rows = sorted(self.latencies.items()) + [("total", [d for ds in self.latencies.values() for d in ds])]
+        for operation, durations in rows:
+            durations = sorted(durations)
+            if not durations:
+                continue
+            p = lambda fraction: durations[min(len(durations) - 1, int(len(durations) * fraction))] * 1000
+            failed = sum(self.failures.values()) if operation == "total" else self.failures[operation]
+            errors = sum(self.errors.values()) if operation == "total" else self.errors[operation]
+            print(f"{operation:<14}{len(durations):>8}{len(durations) / elapsed:>9.1f}{p(0.5):>9.1f}{p(0.95):>9.1f}"
+                  f"{p(0.99):>9.1f}{durations[-1] * 1000:>9.1f}{failed:>8}{errors:>8}")
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(","):
+        operation, weight = entry.split("=")
+        weights[operation.strip()] = float(weight)
+    return weights
+
+
+async def timed(stats, operation, call, semaphore, scheduled):
+    # Latency counts from the scheduled start, waiting for the semaphore included, so that a stalled
+    # system is not hidden by the requests it kept from being sent (coordinated omission)
+    async with semaphore:
+        try:
+            outcome = await call()
+        except Exception as e:
+            # Transport errors and 5xx responses, as opposed to business failures like missing stock
+            outcome = None
+        stats.record(operation, time.perf_counter() - scheduled, outcome)
+
+
+async def benchmark(args):
+    target = HttpTarget(args.url, args.connections) if args.target == "http" else CeleryTarget()
+    workload = Workload(target, args.users, args.items, args.stock, args.credit, args.max_price)
+    mix = parse_mix(args.mix)
+    operations, weights = list(mix), list(mix.values())
+    stats = Stats()
+    semaphore = asyncio.Semaphore(args.max_in_flight)
+
+    try:
+        await workload.seed()
+        credit_before, stock_before = await workload.totals()
+
+        pending = set()
+        started = time.perf_counter()
+        sent = 0
+        while time.perf_counter() - started < args.duration:
+            # Open loop: requests are started on schedule, slow responses do not slow down the arrival rate
+            due = int((time.perf_counter() - started) * args.rps)
+            for i in range(sent, due):
+                operation = random.choices(operations, weights)[0]
+                scheduled = started + i / args.rps
+                pending.add(asyncio.ensure_future(timed(stats, operation, getattr(workload, operation), semaphore, scheduled)))
+            sent = max(sent, due)
+            pending = {task for task in pending if not task.done()}
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*pending)
+        elapsed = time.perf_counter() - started
+
+        stats.report(elapsed)
+
+        credit_after, stock_after = await workload.totals()
+        paid = await workload.paid_total()
+        expected_credit = credit_before + workload.added_credit - paid
+        expected_stock = stock_before + workload.added_stock_value - paid
+        print(f"\npaid orders: {paid} in total")
+        print(f"credit: {credit_before} before, {credit_after} after, {expected_credit} expected")
+        print(f"stock value: {stock_before} before, {stock_after} after, {expected_stock} expected")
+        if credit_after != expected_credit or stock_after != expected_stock:
+            print("CONSISTENCY VIOLATION: credit or stock value does not match the paid orders")
+            if workload.unknown_additions:
+                print(f"({workload.unknown_additions} add_stock/add_funds calls failed with an error and may have been applied)")
+            return 1
+        print("consistency: credit and stock value match the paid orders")
+        return 0
+    finally:
+        await target.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=["http", "celery"], default="http")
+    parser.add_argument('--url', default="http://127.0.0.1:8000", help='gateway (or nginx) URL for the http target')
+    parser.add_argument('--rps', type=float, default=100, help='operations started per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to generate load for')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='operation=weight,... from ' + DEFAULT_MIX)
+    parser.add_argument('--max-in-flight', type=int, default=1000, help='operations waiting for a response at most')
+    parser.add_argument('--connections', type=int, default=200, help='HTTP connection pool size')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--stock', type=int, default=100, help='initial stock of every item')
+    parser.add_argument('--credit', type=int, default=1000, help='initial credit of every user')
+    parser.add_argument('--max-price', type=int, default=20)
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(benchmark(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Round trip latency of Celery tasks with the configured result backend.
+
+Workers publish results with their own configuration, so deploy the services and run this script with
+the same CELERY_RESULT_BACKEND (rpc, redis or a backend URL) for every backend to compare, e.g.
+
+    CELERY_RESULT_BACKEND=redis python -m benchmark.result_backends --tasks 5000 --concurrency 32
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stock.tasks as stock
+from common.celery_config import backend_url
+
+
+def round_trip(_):
+    before = time.perf_counter()
+    # An empty lookup exercises the broker and result backend with a trivial amount of work
+    stock.find_items.delay([]).get(timeout=30)
+    return time.perf_counter() - before
+
+
+def percentile(durations, fraction):
+    return durations[min(len(durations) - 1, int(len(durations) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=2000, help='number of tasks to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='tasks in flight at the same time')
+    parser.add_argument('--warmup', type=int, default=100, help='tasks sent before measuring')
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(round_trip, range(args.warmup)))
+        started = time.perf_counter()
+        durations = sorted(executor.map(round_trip, range(args.tasks)))
+        elapsed = time.perf_counter() - started
+
+    print(f"backend:    {backend_url('stock')}")
+    print(f"tasks:      {args.tasks} ({args.concurrency} concurrent)")
+    print(f"throughput: {args.tasks / elapsed:.1f} tasks/s")
+    print(f"mean:       {statistics.mean(durations) * 1000:.2f} ms")
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        print(f"{name}:        {percentile(durations, fraction) * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
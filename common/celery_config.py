@@ -0,0 +1,92 @@
+import os
+
+from kombu import Queue
+
+from common.serialization import NAME as MSGPACK, register_msgpack
+
+# Shortcuts for CELERY_RESULT_BACKEND, any other value is used as a Celery result backend URL
+RESULT_BACKENDS = {
+    # Results are sent back as messages on a reply queue of the client, over the service broker
+    'rpc': lambda: 'rpc://',
+    'redis': lambda: os.environ.get('CELERY_REDIS_URL', 'redis://redis-master:6379/0'),
+}
+
+
+def backend_url(service):
+    """Result backend of a service: {SERVICE}_RESULT_BACKEND, falling back to CELERY_RESULT_BACKEND and rpc."""
+    backend = os.environ.get(f'{service.upper()}_RESULT_BACKEND', os.environ.get('CELERY_RESULT_BACKEND', 'rpc'))
+    if backend in RESULT_BACKENDS:
+        return RESULT_BACKENDS[backend]()
+    return backend
+
+
+# Serializers selectable with CELERY_SERIALIZER
+SERIALIZERS = {'json': 'json', 'msgpack': MSGPACK}
+
+
+# Tasks are routed to one of three queues per service (e.g. stock.saga, stock.write and stock.read), so
+# that workers can be dedicated to each and a burst of lookups does not queue ahead of a checkout
+QUEUE_KINDS = ('saga', 'write', 'read')
+SERVICES = ('order', 'stock', 'payment')
+# Steps of checkout sagas, and the compensations among them
+SAGA_TASKS = {'reserve_items', 'release_items', 'remove_credit', 'cancel_payment', 'mark_paid', 'mark_unpaid'}
+COMPENSATIONS = {'release_items', 'cancel_payment', 'mark_unpaid'}
+READ_TASKS = {'find_order', 'find_item', 'find_items', 'find_user', 'find_users', 'payment_status',
+              'payment_statuses'}
+
+# Queues are RabbitMQ priority queues. In the saga queue compensations go first, since they release
+# stock and credit held by failed checkouts
+MAX_PRIORITY = 9
+COMPENSATION_PRIORITY = 9
+SAGA_PRIORITY = 5
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """Queue (and priority) of a task, from its name, e.g. stock.tasks.find_item goes to stock.read."""
+    service, function = name.split('.')[0], name.rsplit('.', 1)[-1]
+    if service not in SERVICES:
+        # Celery's own tasks (e.g. celery.chord_unlock) go to the default queue
+        return None
+    if function in SAGA_TASKS:
+        priority = COMPENSATION_PRIORITY if function in COMPENSATIONS else SAGA_PRIORITY
+        return {'queue': f'{service}.saga', 'priority': priority}
+    if function in READ_TASKS:
+        return {'queue': f'{service}.read'}
+    return {'queue': f'{service}.write'}
+
+
+def celery_config(service):
+    """Celery configuration shared by the services, the gateway uses the same one to send tasks."""
+
+    class CeleryConfig:
+        # Celery configuration
+        # http://docs.celeryproject.org/en/latest/configuration.html
+
+        broker_url = os.environ.get(f'{service.upper()}_BROKER_URL', '')
+        result_backend = backend_url(service)
+        # Results are consumed once by the gateway, there is no need to keep them around
+        result_expires = int(os.environ.get('CELERY_RESULT_EXPIRES', '600'))
+
+        # json and msgpack serializers are more secure than the default pickle. Both are accepted, so that
+        # processes configured with different serializers (e.g. during a rolling update) understand each other
+        task_serializer = SERIALIZERS[os.environ.get('CELERY_SERIALIZER', 'json')]
+        result_serializer = task_serializer
+        accept_content = ['json', MSGPACK]
+        result_accept_content = accept_content
+
+        # Mutating tasks take idempotency keys, so tasks are only acknowledged after they ran
+        # and are redelivered when their worker dies
+        task_acks_late = True
+        task_reject_on_worker_lost = True
+        worker_prefetch_multiplier = int(os.environ.get('CELERY_PREFETCH_MULTIPLIER', '4'))
+
+        task_queues = [Queue(f'{service}.{kind}', routing_key=f'{service}.{kind}',
+                             queue_arguments={'x-max-priority': MAX_PRIORITY}) for kind in QUEUE_KINDS]
+        task_default_queue = f'{service}.write'
+        task_routes = (route_task,)
+
+        # Use UTC instead of localtime
+        enable_utc = True
+
+    register_msgpack()
+    return CeleryConfig
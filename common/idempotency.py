@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, WriteConcern
+from pymongo.errors import DuplicateKeyError
+
+# Applied operations are remembered for this long, which bounds how late a redelivery can be detected
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', str(24 * 60 * 60)))
+# An operation still pending after this many seconds is assumed to be abandoned by a dead worker and is taken over
+IDEMPOTENCY_LEASE = float(os.environ.get('IDEMPOTENCY_LEASE', '60'))
+
+PENDING = "pending"
+DONE = "done"
+# Recorded by a compensation for an action that never started, so that the action is skipped if it arrives later
+CANCELLED = "cancelled"
+# Recorded by a compensation that took over an abandoned action, which may have been (partly) applied
+ABANDONED = "abandoned"
+
+
+def create_indexes(operations):
+    operations.create_index([("created_at", ASCENDING)], expireAfterSeconds=IDEMPOTENCY_TTL)
+
+
+def fingerprint(args):
+    """Digest of the arguments of an operation, to tell a replay from a reuse of its key for other arguments."""
+    return hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def unapplied(filter, key):
+    """Filter of an update applying the operation under key, only matching documents it was not applied to yet."""
+    if key is None:
+        return filter
+    return {**filter, "applied_keys": {"$ne": key}}
+
+
+def applying(update, key):
+    """
+    Update that records key in the document in the same write, so that applying the operation again
+    (after its worker died or raised) does not match the document. The key stays in the document until
+    the operation is done, the documents are then listed in its record and the key is dropped from them.
+    Use keyed_update, or report the documents with changed().
+    """
+    if key is None:
+        return update
+    if isinstance(update, list):
+        # Aggregation pipeline update
+        return update + [{"$set": {"applied_keys": {"$concatArrays": [{"$ifNull": ["$applied_keys", []]}, [key]]}}}]
+    return {**update, "$push": {"applied_keys": key}}
+
+
+# Documents the operations running in this process recorded their key in, by key
+_changed = {}
+
+
+def changed(key, collection, document_ids):
+    """Report documents the operation under key recorded its key in, to be listed in its record once it is done."""
+    if key is not None:
+        _changed.setdefault(key, []).extend([collection.name, document_id] for document_id in document_ids)
+
+
+def keyed_update(collection, filter, update, key, session=None):
+    """update_one applying the operation under key to the document if it does not carry key yet (see applying)."""
+    result = collection.update_one(unapplied(filter, key), applying(update, key), session=session)
+    if result.matched_count > 0:
+        changed(key, collection, [filter["_id"]])
+    return result
+
+
+def was_applied(collection, filter, key, session=None):
+    """Whether a document matching filter carries key, i.e. an earlier attempt of the operation was applied to it."""
+    if key is None:
+        return False
+    document = collection.find_one({**filter, "applied_keys": key}, {"_id": 1}, session=session)
+    if document is None:
+        return False
+    changed(key, collection, [document["_id"]])
+    return True
+
+
+def _settle(operations, key, documents):
+    """Drop key from the documents the operation changed, now that its record is done. Unacknowledged, a key
+    that is left behind only costs space."""
+    by_collection = {}
+    for name, document_id in documents:
+        by_collection.setdefault(name, []).append(document_id)
+    for name, document_ids in by_collection.items():
+        collection = operations.database.get_collection(name, write_concern=WriteConcern(w=0))
+        collection.update_many({"_id": {"$in": document_ids}}, {"$pull": {"applied_keys": key}})
+
+
+# Projection leaving the applied keys out of documents that are returned to clients
+HIDE_APPLIED_KEYS = {"applied_keys": 0}
+
+
+def unapplying(update, key):
+    """Update undoing the operation recorded under key, to be applied to the documents carrying it."""
+    return {**update, "$pull": {"applied_keys": key}}
+
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_LEASE)
+
+
+def _expired(record):
+    return record.get("lease_until", datetime.min) <= datetime.utcnow()
+
+
+def _claim(operations, key, state, digest=None):
+    try:
+        operations.insert_one({"_id": key, "state": state, "fingerprint": digest,
+                               "created_at": datetime.utcnow(), "lease_until": _lease()})
+        return None
+    except DuplicateKeyError:
+        # The record may have expired in between
+        return operations.find_one({"_id": key}) or _claim(operations, key, state, digest)
+
+
+def _take_over(operations, record, state):
+    """Move an expired pending record to state, returns whether this worker won the race for it."""
+    result = operations.update_one({"_id": record["_id"], "state": PENDING, "lease_until": record.get("lease_until")},
+                                   {"$set": {"state": state, "lease_until": _lease()}})
+    return result.modified_count > 0
+
+
+def run_once(operations, task, args, key, operation):
+    """
+    Run operation(key) at most once per idempotency key of a task and return its result. A replay of a finished
+    operation returns the recorded result, a replay of one that is still running returns None. An operation
+    whose worker died or raised is run again once its lease expired, so operation must record key in the
+    documents it changes (see applying) and treat documents already carrying it as applied (see was_applied).
+    The documents are listed in the record once the operation is done, and key is dropped from them. Keys are
+    scoped to the task, and a key reused with other arguments is rejected with None. Without a key the operation
+    simply runs, with a key of None.
+    """
+    if key is None:
+        return operation(None)
+    key = f"{task}:{key}"
+    digest = fingerprint(args)
+    record = _claim(operations, key, PENDING, digest)
+    if record is not None:
+        if record.get("fingerprint") not in (None, digest):
+            return None
+        if record["state"] != PENDING or not _expired(record) or not _take_over(operations, record, PENDING):
+            return record.get("result")
+    try:
+        result = operation(key)
+    except Exception:
+        _changed.pop(key, None)
+        # Release the claim so that a retry does not wait for the lease, what was applied is recorded in the documents
+        operations.update_one({"_id": key, "state": PENDING}, {"$set": {"lease_until": datetime.utcnow()}})
+        raise
+    documents = _changed.pop(key, [])
+    # Unless a compensation took the operation over in the meantime, it then needs the keys in the documents
+    done = operations.update_one({"_id": key, "state": PENDING},
+                                 {"$set": {"state": DONE, "result": result, "changed": documents}})
+    if done.modified_count > 0 and documents:
+        _settle(operations, key, documents)
+    return result
+
+
+def undo_once(operations, action, action_key, task, args, key, operation):
+    """
+    Compensate the action (task name) recorded under action_key at most once, by running operation(key, applied_key)
+    like run_once. If the action is done, applied_key is None and its changes are undone. If it was abandoned by its
+    worker it is taken over so that it will not run anymore, and applied_key is the key the action recorded in the
+    documents it changed: only those must be undone. If the action never started it is cancelled instead and nothing
+    needs to be undone; if it failed there is nothing to undo either. Returns None while the action is running,
+    so the compensation can be retried.
+    """
+    if action_key is None:
+        return run_once(operations, task, args, key, lambda key: operation(key, None))
+    applied_key = f"{action}:{action_key}"
+    record = _claim(operations, applied_key, CANCELLED)
+    if record is None or record["state"] == CANCELLED or (record["state"] == DONE and not record.get("result")):
+        return {"success": True}
+    if record["state"] == PENDING:
+        if not _expired(record) or not _take_over(operations, record, ABANDONED):
+            return None
+        record["state"] = ABANDONED
+    if record["state"] == DONE:
+        applied_key = None
+    return run_once(operations, task, args, key, lambda key: operation(key, applied_key))
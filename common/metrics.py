@@ -0,0 +1,268 @@
+"""
+In-process latency histograms and in-flight gauges, rendered in the Prometheus text format.
+
+Observations only take a lock and bump a few counters, so they are cheap enough to leave on.
+Durations are measured with time.perf_counter(). Only the broker queue wait spans two processes,
+so it is measured with wall clocks: the publisher stamps every task with a sent_at header.
+
+Processes serving the same scrape target (e.g. the gunicorn workers of the gateway) share a METRICS_DIR:
+every process writes a snapshot of its metrics there every METRICS_WRITE_INTERVAL seconds, and a scrape
+adds up the snapshots of all of them. Gauges of processes that are gone are left out.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from celery.signals import before_task_publish, task_postrun, task_prerun, worker_init
+
+# Upper bounds in seconds, from a fast cache hit up to a saga step timeout
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_INTERVAL', '1'))
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Histogram():
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [count per bucket (plus +Inf), sum]
+        self.series = {}
+
+    def observe(self, duration, *labels):
+        _share()
+        index = bisect_left(self.buckets, duration)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += duration
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), list(counts), total] for labels, (counts, total) in self.series.items()]
+
+    def merge(self, snapshot):
+        for labels, counts, total in snapshot:
+            series = self.series.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0.0])
+            series[0] = [mine + theirs for mine, theirs in zip(series[0], counts)]
+            series[1] += total
+
+    def empty(self):
+        return Histogram(self.name, self.description, self.label_names, self.buckets)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _labels(self.label_names + ('le',), labels + (bound,))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+class Gauge():
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = defaultdict(int)
+
+    def inc(self, *labels):
+        _share()
+        with self.lock:
+            self.values[labels] += 1
+
+    def dec(self, *labels):
+        with self.lock:
+            self.values[labels] -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, snapshot):
+        for labels, value in snapshot:
+            self.values[tuple(labels)] += value
+
+    def empty(self):
+        return Gauge(self.name, self.description, self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge']
+        with self.lock:
+            values = sorted(self.values.items())
+        lines.extend(f'{self.name}{_labels(self.label_names, labels)} {value}' for labels, value in values)
+        return lines
+
+
+registry = []
+
+
+def histogram(name, description, labels=()):
+    metric = Histogram(name, description, labels)
+    registry.append(metric)
+    return metric
+
+
+def gauge(name, description, labels=()):
+    metric = Gauge(name, description, labels)
+    registry.append(metric)
+    return metric
+
+
+# Process that started the snapshot writer, a forked child starts its own
+_sharing_pid = None
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f'{pid}.json')
+
+
+def _write_snapshot():
+    snapshot = {metric.name: metric.snapshot() for metric in registry}
+    path = _snapshot_path(os.getpid())
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    # Readers see either the previous or the new snapshot, never a partial one
+    os.replace(path + '.tmp', path)
+
+
+def _share():
+    """Start writing snapshots of this process to METRICS_DIR, once per process."""
+    global _sharing_pid
+    if METRICS_DIR is None or _sharing_pid == os.getpid():
+        return
+    _sharing_pid = os.getpid()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    def write_periodically():
+        while True:
+            try:
+                _write_snapshot()
+            except OSError:
+                pass
+            time.sleep(METRICS_WRITE_INTERVAL)
+
+    threading.Thread(target=write_periodically, name='metrics-snapshot', daemon=True).start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _merged():
+    """The metrics of all processes sharing METRICS_DIR, added up."""
+    _share()
+    _write_snapshot()
+    merged = [metric.empty() for metric in registry]
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        alive = _alive(int(os.path.basename(path)[:-len('.json')]))
+        for metric in merged:
+            # Counts of exited processes still add up, what was in flight in them is not anymore
+            if metric.name in snapshot and (alive or isinstance(metric, Histogram)):
+                metric.merge(snapshot[metric.name])
+    return merged
+
+
+def render():
+    """All metrics of this process, or of all processes sharing METRICS_DIR, in the Prometheus text exposition format."""
+    metrics = _merged() if METRICS_DIR else registry
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+# Task metrics of the worker processes
+task_seconds = histogram('worker_task_seconds',
+                         'Time tasks spent in the broker queue (queue_wait) and running (execution)',
+                         ('task', 'phase'))
+tasks_in_flight = gauge('worker_tasks_in_flight', 'Tasks currently running', ('task',))
+
+# Task id -> perf_counter() when the task started running
+_started = {}
+
+
+@before_task_publish.connect
+def _stamp_sent_at(headers=None, **kwargs):
+    # The wall clock of the publisher, compared with the one of the worker to get the queue wait
+    headers.setdefault('sent_at', time.time())
+
+
+def _task_started(task_id=None, task=None, **kwargs):
+    sent_at = getattr(task.request, 'sent_at', None)
+    if sent_at is not None:
+        task_seconds.observe(max(time.time() - sent_at, 0.0), task.name, 'queue_wait')
+    tasks_in_flight.inc(task.name)
+    _started[task_id] = time.perf_counter()
+
+
+def _task_finished(task_id=None, task=None, **kwargs):
+    started = _started.pop(task_id, None)
+    tasks_in_flight.dec(task.name)
+    if started is not None:
+        task_seconds.observe(time.perf_counter() - started, task.name, 'execution')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_worker_metrics():
+    """
+    Record task timings in this worker and serve them over HTTP on METRICS_PORT (if set). The server runs
+    in the worker process, so it sees the tasks of the pools that run there (gevent, threads, solo) but not
+    those of prefork children.
+    """
+    task_prerun.connect(_task_started, weak=False)
+    task_postrun.connect(_task_finished, weak=False)
+
+    def start_server(**kwargs):
+        port = os.environ.get('METRICS_PORT')
+        if port:
+            server = ThreadingHTTPServer(('0.0.0.0', int(port)), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    worker_init.connect(start_server, weak=False)
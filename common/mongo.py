@@ -0,0 +1,101 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from celery.concurrency import get_implementation
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import worker_init, worker_process_init
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# pymongo client options read from the environment, e.g. MONGO_MAX_POOL_SIZE=50.
+# Without MONGO_MAX_POOL_SIZE the pool matches the number of tasks a process runs concurrently.
+CLIENT_OPTIONS = {
+    'maxPoolSize': ('MONGO_MAX_POOL_SIZE', None),
+    'minPoolSize': ('MONGO_MIN_POOL_SIZE', '1'),
+    'maxIdleTimeMS': ('MONGO_MAX_IDLE_TIME_MS', None),
+    'waitQueueTimeoutMS': ('MONGO_WAIT_QUEUE_TIMEOUT_MS', None),
+    'connectTimeoutMS': ('MONGO_CONNECT_TIMEOUT_MS', '5000'),
+    'socketTimeoutMS': ('MONGO_SOCKET_TIMEOUT_MS', None),
+    'serverSelectionTimeoutMS': ('MONGO_SERVER_SELECTION_TIMEOUT_MS', '10000'),
+}
+
+
+def client_options(concurrency=None):
+    options = {'maxPoolSize': max(concurrency, 1)} if concurrency else {}
+    for option, (variable, default) in CLIENT_OPTIONS.items():
+        value = os.environ.get(variable, default)
+        if value is not None:
+            options[option] = int(value)
+    return options
+
+
+def connect(url, concurrency=None):
+    """Create a client with the configured pool and open its first connection right away, so that
+    the first task does not pay for it (minPoolSize connections are then opened in the background).
+    The client is returned even if the database cannot be reached yet, it keeps trying to connect."""
+    client = MongoClient(url, **client_options(concurrency))
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        # Raised from a worker signal handler this would only be logged by Celery, leaving the worker without a client
+        logger.exception("Could not reach the database at startup, connecting in the background")
+    atexit.register(client.close)
+    return client
+
+
+# Seconds between attempts of a setup step (index creation, migration) while the database cannot be reached
+SETUP_RETRY_INTERVAL = float(os.environ.get('MONGO_SETUP_RETRY_INTERVAL', '5'))
+
+
+def set_up(step):
+    """
+    Run a setup step that needs the database, like creating indexes. If the database cannot be reached the
+    step is retried in the background until it succeeds, so that a worker started before its database still
+    comes up with all its collections defined.
+    """
+    def attempt():
+        try:
+            step()
+            return True
+        except PyMongoError as e:
+            logger.warning("Database setup (%s) failed, retrying: %s", step.__name__, e)
+            return False
+
+    def retry():
+        while not attempt():
+            time.sleep(SETUP_RETRY_INTERVAL)
+
+    if not attempt():
+        threading.Thread(target=retry, name='db-setup', daemon=True).start()
+
+
+def supports_transactions(client):
+    """
+    Whether multi-document transactions can be used: they need a replica set or mongos (sharded chart), not a
+    standalone server. The topology is Unknown until the client reached the server, which counts as no support,
+    so this is checked on every use rather than once at startup.
+    """
+    return client.topology_description.topology_type_name not in ("Single", "Unknown")
+
+
+def connect_per_process(init):
+    """
+    Call init(concurrency) in every process that runs tasks, with the number of tasks that process runs
+    at the same time. A MongoClient is not fork-safe, so with the prefork pool every child runs it after
+    the fork and runs one task at a time, while the other pools (solo, threads, gevent) run all tasks
+    in the worker process itself.
+    """
+    def init_child(**kwargs):
+        init(1)
+
+    def init_worker(sender=None, **kwargs):
+        if not issubclass(get_implementation(sender.pool_cls), PreforkPool):
+            init(sender.concurrency)
+
+    worker_process_init.connect(init_child, weak=False)
+    worker_init.connect(init_worker, weak=False)
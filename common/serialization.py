@@ -0,0 +1,34 @@
+import msgpack
+from bson import ObjectId
+from kombu.serialization import register
+
+# Compact binary alternative to json for task payloads and results. Like json (and unlike pickle)
+# decoding only ever builds plain data, ObjectIds being the one extension type.
+NAME = 'wdm-msgpack'
+CONTENT_TYPE = 'application/x-wdm-msgpack'
+
+OBJECT_ID = 1
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(OBJECT_ID, value.binary)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _ext_hook(code, data):
+    if code == OBJECT_ID:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def dumps(value):
+    return msgpack.packb(value, default=_default, use_bin_type=True)
+
+
+def loads(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def register_msgpack():
+    register(NAME, dumps, loads, content_type=CONTENT_TYPE, content_encoding='binary')
@@ -0,0 +1,206 @@
+"""
+Request tracing across the gateway, the Celery workers and Mongo.
+
+The gateway starts a trace for every request. Its id and the current span travel in the headers of the
+tasks it sends, so the spans the workers record for their tasks and Mongo commands join the same trace.
+Finished spans are handed to the exporter selected with TRACE_EXPORTER, and tracing is off without one.
+"""
+import importlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from pymongo import monitoring
+
+# Name of this process in its spans, set by trace_worker_tasks in the workers
+service = os.environ.get('TRACE_SERVICE', 'gateway')
+
+trace_id = ContextVar('trace_id', default=None)
+span_id = ContextVar('span_id', default=None)
+
+
+class _Writer():
+    """
+    Writes spans as JSON lines from a background thread, off the request path. The thread (and the
+    stream, returned by open_stream()) are created on the first span of every process, since threads
+    do not survive a fork.
+    """
+
+    def __init__(self, open_stream):
+        self.open_stream = open_stream
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.spans = queue.SimpleQueue()
+                    threading.Thread(target=self._write, args=(self.open_stream(), self.spans), name='trace-writer',
+                                     daemon=True).start()
+                    self.pid = os.getpid()
+        self.spans.put(span)
+
+    def _write(self, stream, spans):
+        while True:
+            span = spans.get()
+            stream.write(json.dumps(span) + '\n')
+            if spans.empty():
+                stream.flush()
+
+
+class StdoutExporter(_Writer):
+    def __init__(self):
+        super().__init__(lambda: sys.stdout)
+
+
+class FileExporter(_Writer):
+    """Appends to TRACE_FILE, one file per process so that concurrent writers do not interleave."""
+
+    def __init__(self):
+        super().__init__(self._open_file)
+
+    @staticmethod
+    def _open_file():
+        root, extension = os.path.splitext(os.environ.get('TRACE_FILE', 'traces.jsonl'))
+        return open(f'{root}.{os.getpid()}{extension}', 'a', buffering=1 << 16)
+
+
+# Shortcuts for TRACE_EXPORTER, any other value is imported as module:attribute and called to create
+# the exporter, an object with an export(span) method
+EXPORTERS = {
+    'stdout': StdoutExporter,
+    'file': FileExporter,
+}
+
+
+def _create_exporter(name):
+    if not name:
+        return None
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+    module, attribute = name.split(':')
+    return getattr(importlib.import_module(module), attribute)()
+
+
+exporter = _create_exporter(os.environ.get('TRACE_EXPORTER'))
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+def _emit(name, span, parent, started, duration, attributes):
+    exporter.export({
+        'trace_id': trace_id.get(),
+        'span_id': span,
+        'parent_id': parent,
+        'service': service,
+        'name': name,
+        'start': started,
+        'duration': duration,
+        'attributes': attributes,
+    })
+
+
+def record(name, started, duration, **attributes):
+    """Export a finished child span of the current span, e.g. for a Mongo command."""
+    if exporter is not None and trace_id.get() is not None:
+        _emit(name, _new_id(), span_id.get(), started, duration, attributes)
+
+
+@contextmanager
+def span(name, new_trace=None, **attributes):
+    """
+    Time the enclosed code as a span, child of the current one. With new_trace (a trace id, or True for
+    a new one) a trace is started, otherwise spans outside of a trace are not recorded.
+    """
+    if exporter is None or (new_trace is None and trace_id.get() is None):
+        yield
+        return
+    trace_token = trace_id.set(_new_id() if new_trace is True else new_trace) if new_trace else None
+    parent = span_id.get()
+    span_token = span_id.set(_new_id())
+    started = time.time()
+    before = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attributes['error'] = type(e).__name__
+        raise
+    finally:
+        _emit(name, span_id.get(), parent, started, time.perf_counter() - before, attributes)
+        span_id.reset(span_token)
+        if trace_token is not None:
+            trace_id.reset(trace_token)
+
+
+@before_task_publish.connect
+def _propagate(headers=None, **kwargs):
+    if trace_id.get() is not None:
+        headers['trace_id'] = trace_id.get()
+        headers['parent_span_id'] = span_id.get()
+
+
+# Task id -> (context variable tokens, parent span, wall clock start, perf_counter start) of the running tasks
+_task_spans = {}
+
+
+def _task_started(task_id=None, task=None, **kwargs):
+    request_trace_id = getattr(task.request, 'trace_id', None)
+    if request_trace_id is None:
+        return
+    tokens = (trace_id.set(request_trace_id), span_id.set(_new_id()))
+    parent = getattr(task.request, 'parent_span_id', None)
+    _task_spans[task_id] = (tokens, parent, time.time(), time.perf_counter())
+
+
+def _task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_spans.pop(task_id, None)
+    if started is None:
+        return
+    (trace_token, span_token), parent, wall_clock, before = started
+    _emit(f'task {task.name}', span_id.get(), parent, wall_clock, time.perf_counter() - before, {'state': state})
+    span_id.reset(span_token)
+    trace_id.reset(trace_token)
+
+
+def trace_worker_tasks(name):
+    """Record a span for every task this worker (of the service name) runs as part of a trace."""
+    global service
+    service = os.environ.get('TRACE_SERVICE', name)
+    if exporter is not None:
+        task_prerun.connect(_task_started, weak=False)
+        task_postrun.connect(_task_finished, weak=False)
+
+
+class CommandTracer(monitoring.CommandListener):
+    """Records Mongo commands as spans of the trace of the code that sent them."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, 'ok')
+
+    def failed(self, event):
+        self._record(event, 'failed')
+
+    def _record(self, event, outcome):
+        if trace_id.get() is None:
+            return
+        duration = event.duration_micros / 1e6
+        record(f'mongo {event.command_name}', time.time() - duration, duration,
+               database=event.database_name, outcome=outcome)
+
+
+# Listeners apply to the clients created afterwards, so this runs before any client is created
+if exporter is not None:
+    monitoring.register(CommandTracer())
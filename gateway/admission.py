@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+# Requests running at the same time per route of a gateway worker, and requests waiting for a slot.
+# Requests beyond that, or waiting longer than MAX_QUEUE_WAIT seconds, are rejected right away with a 503
+# rather than piling up until nginx or gunicorn time them out.
+MAX_IN_FLIGHT = int(os.environ.get('GATEWAY_MAX_IN_FLIGHT', '256'))
+MAX_QUEUED = int(os.environ.get('GATEWAY_MAX_QUEUED', '512'))
+MAX_QUEUE_WAIT = float(os.environ.get('GATEWAY_MAX_QUEUE_WAIT', '1'))
+# Per route overrides of MAX_IN_FLIGHT, e.g. "/orders/checkout/{order_id}=64,/stock/find/{item_id}=512", 0 for no limit
+ROUTE_LIMITS = dict((route, int(limit)) for route, limit in
+                    (entry.rsplit('=', 1) for entry in os.environ.get('GATEWAY_ROUTE_LIMITS', '').split(',') if entry))
+# Health checks and metrics are never limited
+UNLIMITED_ROUTES = {'/', '/metrics'}
+
+# Seconds a request may take, within nginx's 65s proxy timeout. Clients can ask for less with X-Request-Timeout.
+REQUEST_TIMEOUT = float(os.environ.get('GATEWAY_REQUEST_TIMEOUT', '60'))
+
+# time.monotonic() by which the current request must be answered, None outside of requests
+deadline = ContextVar('deadline', default=None)
+
+
+class Overloaded(Exception):
+    """The gateway has no capacity or time left for the request, answered with a 503."""
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time while a write may still be applied, answered with a 504. Unlike an
+    Overloaded request it is not safe to blindly retry, so no Retry-After is sent."""
+
+
+def remaining():
+    """Seconds left before the deadline of the current request, None without one."""
+    current = deadline.get()
+    if current is None:
+        return None
+    return current - time.monotonic()
+
+
+def request_deadline(requested=None):
+    timeout = REQUEST_TIMEOUT
+    try:
+        if requested is not None:
+            timeout = min(timeout, float(requested))
+    except ValueError:
+        pass
+    return time.monotonic() + timeout
+
+
+class Limiter():
+    """Limits the requests running at the same time, with a bounded queue of waiting requests."""
+
+    def __init__(self, limit, max_queued=MAX_QUEUED, max_wait=MAX_QUEUE_WAIT):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.semaphore = asyncio.Semaphore(limit)
+        self.queued = 0
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.semaphore.locked():
+            if self.queued >= self.max_queued:
+                raise Overloaded("Too many requests waiting")
+            wait = self.max_wait
+            if remaining() is not None:
+                wait = min(wait, remaining())
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=max(wait, 0))
+            except asyncio.TimeoutError:
+                raise Overloaded("No capacity to handle the request in time")
+            finally:
+                self.queued -= 1
+        else:
+            await self.semaphore.acquire()
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+
+def limiter(route):
+    """Limiter of a route, None for routes without limit."""
+    limit = ROUTE_LIMITS.get(route, 0 if route in UNLIMITED_ROUTES else MAX_IN_FLIGHT)
+    return Limiter(limit) if limit > 0 else None
@@ -1,25 +1,70 @@
-from fastapi import FastAPI, status, HTTPException, APIRouter, Request, Response
+from fastapi import FastAPI, status, HTTPException, APIRouter, Request, Response, Header
+from fastapi.responses import PlainTextResponse
 from fastapi.routing import APIRoute
 
+import asyncio
+import os
 import time
-from typing import Callable
+from typing import Callable, List, Optional
 from celery import group
+from pydantic import BaseModel
 import payment.tasks as payment
 import stock.tasks as stock
 import order.tasks as orders
 
-from .saga import Saga, State
+from common import metrics, tracing
+from . import admission
+from .batching import BatchLoader
+from .cache import price_cache
+from .reads import direct_reads
+from .results import run
+from .saga import Saga, State, recover_periodically
+from .saga_log import SagaLog
+
+request_seconds = metrics.histogram('gateway_request_seconds', 'Time spent handling requests',
+                                    ('method', 'route', 'status'))
+requests_in_flight = metrics.gauge('gateway_requests_in_flight', 'Requests being handled', ('method', 'route'))
 
 class TimedRoute(APIRoute):
     def get_route_handler(self) -> Callable:
         original_route_handler = super().get_route_handler()
+        # Requests are labelled with the path template, not the path, to keep the number of series bounded
+        route = self.path
+        limiter = admission.limiter(route)
 
         async def custom_route_handler(request: Request) -> Response:
-            before = time.time()
-            response: Response = await original_route_handler(request)
-            duration = time.time() - before
+            method = request.method
+            requests_in_flight.inc(method, route)
+            before = time.perf_counter()
+            status_code = 500
+            admission.deadline.set(admission.request_deadline(request.headers.get("X-Request-Timeout")))
+            # Every request starts a trace, or continues the one of the caller given in X-Trace-Id
+            with tracing.span(f"{method} {route}", new_trace=request.headers.get("X-Trace-Id") or True):
+                trace_id = tracing.trace_id.get()
+                try:
+                    if limiter is None:
+                        response: Response = await original_route_handler(request)
+                    else:
+                        async with limiter.admit():
+                            response: Response = await original_route_handler(request)
+                    status_code = response.status_code
+                except HTTPException as e:
+                    status_code = e.status_code
+                    raise
+                except admission.Overloaded as e:
+                    # Shed load early: the client can retry later instead of waiting for a proxy timeout
+                    status_code = 503
+                    raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+                except admission.DeadlineExceeded as e:
+                    status_code = 504
+                    raise HTTPException(status_code=504, detail=str(e))
+                finally:
+                    duration = time.perf_counter() - before
+                    requests_in_flight.dec(method, route)
+                    request_seconds.observe(duration, method, route, status_code)
             response.headers["Response-Time"] = str(duration)
-            print(f"route duration: {duration}")
+            if trace_id is not None:
+                response.headers["X-Trace-Id"] = trace_id
             return response
 
         return custom_route_handler
@@ -27,34 +72,96 @@ class TimedRoute(APIRoute):
 app = FastAPI()
 router = APIRouter(route_class=TimedRoute)
 
+# Sagas are only logged (and recoverable after a crash) when a database for the log is configured
+saga_log = SagaLog(os.environ['SAGA_DB_URL']) if os.environ.get('SAGA_DB_URL') else None
+saga_recovery = None
+
+@app.on_event("startup")
+async def start_saga_recovery():
+    global saga_recovery
+    if saga_log is not None:
+        apps = {"order": orders.app, "payment": payment.app, "stock": stock.app}
+        saga_recovery = asyncio.create_task(recover_periodically(saga_log, apps))
+
+# Bulk creations are split into tasks of at most this many documents, which run concurrently
+BATCH_SIZE = int(os.environ.get('GATEWAY_BATCH_SIZE', '10000'))
+
+# Lookups that can be served from the databases directly in the direct read mode
+READ_TASKS = {"find_order": orders.find_order, "find_items": stock.find_items, "find_users": payment.find_users}
+
+async def read(name, *args):
+    """Run a lookup task, or its direct database equivalent in the direct read mode. Item and user
+    lookups are batched with those of concurrent requests."""
+    if name in LOADERS:
+        return await LOADERS[name].load(*args)
+    if direct_reads is not None:
+        return await getattr(direct_reads, name)(*args)
+    task, result = await run(READ_TASKS[name].s(*args))
+    return result
+
+# Collect the single lookups of concurrent requests into one bulk lookup per service
+price_loader = BatchLoader(lambda item_ids: read("find_items", item_ids))
+LOADERS = {"find_item": BatchLoader(lambda item_ids: read("find_items", item_ids, True)),
+           "find_user": BatchLoader(lambda user_ids: read("find_users", user_ids))}
+
+async def find_prices(item_ids):
+    """Fetch the price of every item id, going to the stock service in a batch (shared with concurrent
+    requests) for the ids that are not cached. Returns None if any item does not exist."""
+    prices, missing = await price_cache.get_many(set(item_ids))
+    if missing:
+        found = await price_loader.load_many(missing)
+        if any(item_id not in found for item_id in missing):
+            return None
+        found = {item_id: int(price) for item_id, price in found.items()}
+        await price_cache.put_many(found)
+        prices.update(found)
+    return prices
+
 @router.get('/', status_code=status.HTTP_200_OK)
 async def index():
     return "Health check"
 
+@router.get('/stock/price_cache', status_code=status.HTTP_200_OK)
+async def price_cache_stats():
+    return price_cache.stats()
+
+@router.get('/metrics', status_code=status.HTTP_200_OK)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @router.post('/payment/create_user', status_code=status.HTTP_200_OK)
 async def create_user():
-    task = payment.create_user.delay()
-    user = task.get()
+    task, user = await run(payment.create_user.s())
     if user and not task.failed():
         return user
     else:
         raise HTTPException(status_code=500, detail="Error creating user")
 
 
+@router.post('/payment/create_users/{n}/{credit}', status_code=status.HTTP_200_OK)
+async def create_users(n: int, credit: int):
+    if n < 1:
+        return {"user_ids": []}
+    sizes = [min(BATCH_SIZE, n - start) for start in range(0, n, BATCH_SIZE)]
+    task, batches = await run(group([payment.create_users.s(size, credit) for size in sizes]))
+    if all(batches) and not task.failed():
+        return {"user_ids": [user_id for batch in batches for user_id in batch["user_ids"]]}
+    else:
+        raise HTTPException(status_code=500, detail="Error creating users")
+
+
 @router.get('/payment/find_user/{user_id}', status_code=status.HTTP_200_OK)
 async def find_user(user_id: str):
-    task = payment.find_user.delay(user_id)
-    user = task.get()
-    if user and not task.failed():
+    user = await read("find_user", user_id)
+    if user:
         return user
     else:
         raise HTTPException(status_code=404, detail="User not found")
 
 
 @router.post('/payment/add_funds/{user_id}/{amount}', status_code=status.HTTP_200_OK)
-async def add_credit(user_id: str, amount: int):
-    task = payment.add_credit.delay(user_id, amount)
-    result = task.get()
+async def add_credit(user_id: str, amount: int, idempotency_key: Optional[str] = Header(default=None)):
+    task, result = await run(payment.add_credit.s(user_id, amount, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"Success": True}
     else:
@@ -62,9 +169,8 @@ async def add_credit(user_id: str, amount: int):
 
 
 @router.post('/payment/pay/{user_id}/{order_id}/{amount}', status_code=status.HTTP_200_OK)
-async def remove_credit(user_id: str, order_id: str, amount: int):
-    task = payment.remove_credit.delay(user_id, amount)
-    result = task.get()
+async def remove_credit(user_id: str, order_id: str, amount: int, idempotency_key: Optional[str] = Header(default=None)):
+    task, result = await run(payment.remove_credit.s(user_id, order_id, amount, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"Success": True}
     else:
@@ -72,9 +178,8 @@ async def remove_credit(user_id: str, order_id: str, amount: int):
 
 
 @router.post('/payment/cancel/{user_id}/{order_id}/{amount}', status_code=status.HTTP_200_OK)
-async def cancel_payment(user_id: str, order_id: str, amount: int):
-    task = payment.cancel_payment.delay(user_id, amount)
-    result = task.get()
+async def cancel_payment(user_id: str, order_id: str, amount: int, idempotency_key: Optional[str] = Header(default=None)):
+    task, result = await run(payment.cancel_payment.s(user_id, order_id, amount, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"Success": True}
     else:
@@ -83,8 +188,7 @@ async def cancel_payment(user_id: str, order_id: str, amount: int):
 
 @router.post('/payment/status/{user_id}/{order_id}', status_code=status.HTTP_200_OK)
 async def payment_status(user_id: str, order_id: str):
-    task = payment.payment_status.delay(user_id, order_id)
-    result = task.get()
+    task, result = await run(payment.payment_status.s(user_id, order_id))
     if result and not task.failed():
         return result
     else:
@@ -92,37 +196,61 @@ async def payment_status(user_id: str, order_id: str):
 
 @router.post('/stock/item/create/{price}', status_code=status.HTTP_200_OK)
 async def create_item(price: int):
-    task = stock.create_item.delay(price)
-    item = task.get()
+    task, item = await run(stock.create_item.s(price))
     if item and not task.failed():
+        await price_cache.put_many({item["item_id"]: int(price)})
         return item
     else:
         raise HTTPException(status_code=500, detail="Error creating item")
 
+class NewItem(BaseModel):
+    price: int
+    stock: int = 0
+
+@router.post('/stock/items/create', status_code=status.HTTP_200_OK)
+async def create_items(items: List[NewItem]):
+    if not items:
+        return {"item_ids": []}
+    items = [item.dict() for item in items]
+    batches = [items[start:start + BATCH_SIZE] for start in range(0, len(items), BATCH_SIZE)]
+    task, results = await run(group([stock.create_items.s(batch) for batch in batches]))
+    if all(results) and not task.failed():
+        item_ids = [item_id for result in results for item_id in result["item_ids"]]
+        await price_cache.put_many({item_id: item["price"] for item_id, item in zip(item_ids, items)})
+        return {"item_ids": item_ids}
+    else:
+        raise HTTPException(status_code=500, detail="Error creating items")
+
 @router.get('/stock/find/{item_id}', status_code=status.HTTP_200_OK)
 async def find_item(item_id: str):
-    task = stock.find_item.delay(item_id)
-    item = task.get()
-    if item and not task.failed():
+    item = await read("find_item", item_id)
+    if item:
         return item
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
 
 @router.post('/stock/add/{item_id}/{amount}', status_code=status.HTTP_200_OK)
-async def add_stock(item_id: str, amount: int):
-    task = stock.add_stock.delay(item_id, amount)
-    result = task.get()
+async def add_stock(item_id: str, amount: int, idempotency_key: Optional[str] = Header(default=None)):
+    task, result = await run(stock.add_stock.s(item_id, amount, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"Success": True}
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
 
+@router.post('/stock/shard/{item_id}/{shards}', status_code=status.HTTP_200_OK)
+async def shard_item(item_id: str, shards: int):
+    task, result = await run(stock.shard_item.s(item_id, shards))
+    if result and not task.failed():
+        return {"Success": True}
+    else:
+        raise HTTPException(status_code=400, detail="Item not found or already sharded")
+
+
 @router.post('/stock/subtract/{item_id}/{amount}', status_code=status.HTTP_200_OK)
-async def remove_stock(item_id: str, amount: int):
-    task = stock.remove_stock.delay(item_id, amount)
-    result = task.get()
+async def remove_stock(item_id: str, amount: int, idempotency_key: Optional[str] = Header(default=None)):
+    task, result = await run(stock.remove_stock.s(item_id, amount, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"Success": True}
     else:
@@ -130,8 +258,7 @@ async def remove_stock(item_id: str, amount: int):
     
 @router.post('/orders/create/{user_id}', status_code=status.HTTP_200_OK)
 async def create_order(user_id):
-    task = orders.create_order.delay(user_id)
-    order = task.get()
+    task, order = await run(orders.create_order.s(user_id))
     if order and not task.failed():
         return order
     else:
@@ -140,17 +267,21 @@ async def create_order(user_id):
 
 @router.delete('/orders/remove/{order_id}', status_code=status.HTTP_200_OK)
 async def remove_order(order_id):
-    task = orders.remove_order.delay(order_id)
-    result = task.get()
+    task, result = await run(orders.remove_order.s(order_id))
     if result and not task.failed():
         return {"success": True}
     else:
         raise HTTPException(status_code=404, detail="Order not found")
 
 @router.post('/orders/addItem/{order_id}/{item_id}', status_code=status.HTTP_200_OK)
-async def add_item(order_id, item_id):
-    task = orders.add_item.delay(order_id, item_id)
-    result = task.get()
+@router.post('/orders/addItem/{order_id}/{item_id}/{quantity}', status_code=status.HTTP_200_OK)
+async def add_item(order_id, item_id, quantity: int = 1, idempotency_key: Optional[str] = Header(default=None)):
+    if quantity < 1:
+        raise HTTPException(status_code=400, detail="Quantity must be positive")
+    prices = await find_prices([item_id])
+    if prices is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    task, result = await run(orders.add_item.s(order_id, item_id, prices[item_id], quantity, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"success": True}
     else:
@@ -158,9 +289,8 @@ async def add_item(order_id, item_id):
 
 
 @router.delete('/orders/removeItem/{order_id}/{item_id}', status_code=status.HTTP_200_OK)
-async def remove_item(order_id, item_id):
-    task = orders.remove_item.delay(order_id, item_id)
-    result = task.get()
+async def remove_item(order_id, item_id, idempotency_key: Optional[str] = Header(default=None)):
+    task, result = await run(orders.remove_item.s(order_id, item_id, idempotency_key=idempotency_key))
     if result and not task.failed():
         return {"success": True}
     else:
@@ -168,45 +298,55 @@ async def remove_item(order_id, item_id):
 
 @router.get('/orders/find/{order_id}', status_code=status.HTTP_200_OK)
 async def find_order(order_id):
-    task = orders.find_order.delay(order_id)
-    order = task.get()
+    order = await read("find_order", order_id)
     
     if order:
-        items = order["items"]
-        items_task = group([stock.find_item.s(item_id) for item_id in items]).delay()
-        total_cost = 0
-        
-        for item in items_task.get():
-            total_cost += int(item["price"])
-        order["total_cost"] = total_cost
         return order
     else:
         raise HTTPException(status_code=404, detail="Order not found")
 
 
+# Checkouts in flight in this worker, by order id
+checkouts = {}
+
 @router.post('/orders/checkout/{order_id}', status_code=status.HTTP_200_OK)
 async def checkout(order_id):
-    task = orders.find_order.delay(order_id)
-    order = task.get()
-    if order:
+    # Retries of a checkout that is still running wait for its outcome instead of starting another saga.
+    # The saga is shielded so that a client giving up does not cancel it for the others.
+    if order_id not in checkouts:
+        future = asyncio.ensure_future(checkout_order(order_id))
+        checkouts[order_id] = future
+        future.add_done_callback(lambda _: checkouts.pop(order_id, None))
+    try:
+        return await asyncio.wait_for(asyncio.shield(checkouts[order_id]), timeout=admission.remaining())
+    except asyncio.TimeoutError:
+        raise admission.DeadlineExceeded("Checkout still running, retry to get its outcome")
+
+
+async def checkout_order(order_id):
+    # The saga outlives the request that started it: others may wait for it and compensations must run
+    admission.deadline.set(None)
+    order = await read("find_order", order_id)
+    if order and order.get("paid"):
+        return {"Success": True}
+    elif order:
         user_id = order["user_id"]
-        total_cost = 0
-        items = order["items"]
-        items_task = group([stock.find_item.s(item_id) for item_id in items]).delay()
+        total_cost = order["total_cost"]
+        lines = order["items"]
 
-        saga = Saga()
+        saga = Saga(log=saga_log)
 
-        for item in items_task.get():
-            total_cost += int(item["price"])
+        # One saga step reserving the full quantity of every line at once
+        saga.add_step("Decrease stock", stock.reserve_items.s(lines), stock.release_items.s(lines), "stock")
 
-            # One saga step for each item to update
-            saga.add_step(f"Decrease {item['_id']}", stock.remove_stock.s(item['_id'], 1), stock.add_stock.s(item['_id'], 1))
-
-        # One saga step for payment
+        # One saga step for payment, independent of the stock so it runs concurrently with it
         saga.add_step(f"Payment user {user_id}: {total_cost}", payment.remove_credit.s(user_id, order_id, total_cost), 
-                      payment.cancel_payment.s(user_id, order_id, total_cost))
+                      payment.cancel_payment.s(user_id, order_id, total_cost), "payment")
+
+        # Once stock and payment are taken the order is marked paid, so that later checkouts stop at the lookup
+        saga.add_step("Mark order paid", orders.mark_paid.s(order_id), orders.mark_unpaid.s(order_id), "order", group=1)
 
-        state = saga.run()
+        state = await saga.run()
 
         if state == State.SUCCESS:
             return {"Success": True}
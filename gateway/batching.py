@@ -0,0 +1,83 @@
+import asyncio
+import contextvars
+import os
+import time
+
+from .admission import REQUEST_TIMEOUT, Overloaded, deadline, remaining
+
+# Lookups of concurrent requests are collected for up to BATCH_WINDOW seconds, or until BATCH_MAX_KEYS
+# distinct keys are waiting, and fetched together. With a window of 0 only the lookups made in the same
+# iteration of the event loop are batched.
+BATCH_WINDOW = float(os.environ.get('GATEWAY_BATCH_WINDOW_MS', '2')) / 1000
+BATCH_MAX_KEYS = int(os.environ.get('GATEWAY_BATCH_MAX_KEYS', '100'))
+
+
+class BatchLoader():
+    """
+    Coalesces single-key lookups of concurrent requests into bulk lookups. fetch(keys) is awaited with a
+    list of distinct keys and returns a dict of key -> value, keys missing from it resolve to None.
+    Lookups of a key that is still waiting in the batch share its result. A key already being fetched is fetched
+    again, since that fetch may have been sent before a write the new lookup must see.
+    """
+
+    def __init__(self, fetch, window=BATCH_WINDOW, max_keys=BATCH_MAX_KEYS):
+        self.fetch = fetch
+        self.window = window
+        self.max_keys = max_keys
+        # Futures of the keys in the batch that was not sent yet
+        self.futures = {}
+        self.batch = []
+        # Latest deadline of the requests waiting on the batch
+        self.deadline = None
+        self.timer = None
+
+    async def load(self, key):
+        waiting_until = deadline.get()
+        if waiting_until is None:
+            waiting_until = time.monotonic() + REQUEST_TIMEOUT
+        self.deadline = waiting_until if self.deadline is None else max(self.deadline, waiting_until)
+        future = self.futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.futures[key] = loop.create_future()
+            # Nobody may be left to retrieve the error when all waiting requests gave up
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self.batch.append(key)
+            if len(self.batch) >= self.max_keys:
+                self._flush()
+            elif self.timer is None:
+                self.timer = loop.call_later(self.window, self._flush)
+        # The fetch is shared, so a request giving up must not cancel it for the others
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=remaining())
+        except asyncio.TimeoutError:
+            raise Overloaded("Request deadline exceeded")
+
+    async def load_many(self, keys):
+        """Values of several keys as a dict, leaving out the keys without a value."""
+        keys = list(dict.fromkeys(keys))
+        values = await asyncio.gather(*[self.load(key) for key in keys])
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        keys, self.batch = self.batch, []
+        futures, self.futures = self.futures, {}
+        # A fetch serves many requests, so it runs outside of the context (trace) of any of them,
+        # bounded by the deadline of the request that waits the longest
+        context = contextvars.Context()
+        context.run(deadline.set, self.deadline)
+        self.deadline = None
+        asyncio.get_running_loop().create_task(self._fetch(keys, futures), context=context)
+
+    async def _fetch(self, keys, futures):
+        try:
+            values = await self.fetch(keys)
+        except Exception as e:
+            for key in keys:
+                futures[key].set_exception(e)
+            return
+        for key in keys:
+            futures[key].set_result(values.get(key) if values else None)
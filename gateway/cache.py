@@ -0,0 +1,92 @@
+import os
+import time
+from collections import OrderedDict
+
+
+class PriceCache():
+    """
+    Read-through cache of item prices. Prices never change after an item is created, so entries
+    only expire to bound staleness and memory. A local LRU is checked first, then an optional
+    Redis tier shared between gateway workers, and only the remaining misses go to the stock service.
+    """
+
+    def __init__(self, max_size=100000, ttl=300, redis_url=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.redis = None
+        if redis_url:
+            import redis.asyncio as redis
+            self.redis = redis.from_url(redis_url)
+
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def _get_local(self, item_id):
+        entry = self.entries.get(item_id)
+        if entry is None:
+            return None
+        price, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[item_id]
+            return None
+        self.entries.move_to_end(item_id)
+        return price
+
+    def _put_local(self, item_id, price):
+        self.entries[item_id] = (price, time.monotonic() + self.ttl)
+        self.entries.move_to_end(item_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get_many(self, item_ids):
+        """Return the cached prices of the given ids and the list of ids that were not cached."""
+        prices = {}
+        missing = []
+        for item_id in item_ids:
+            price = self._get_local(item_id)
+            if price is None:
+                missing.append(item_id)
+            else:
+                prices[item_id] = price
+        self.hits += len(prices)
+
+        if missing and self.redis is not None:
+            try:
+                values = await self.redis.mget([f"price:{item_id}" for item_id in missing])
+            except Exception as e:
+                # The shared tier is only an optimization, an unavailable Redis counts as a miss
+                values = [None] * len(missing)
+            still_missing = []
+            for item_id, value in zip(missing, values):
+                if value is None:
+                    still_missing.append(item_id)
+                else:
+                    prices[item_id] = int(value)
+                    self._put_local(item_id, prices[item_id])
+            self.redis_hits += len(missing) - len(still_missing)
+            missing = still_missing
+
+        self.misses += len(missing)
+        return prices, missing
+
+    async def put_many(self, prices):
+        for item_id, price in prices.items():
+            self._put_local(item_id, price)
+        if prices and self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for item_id, price in prices.items():
+                        pipe.set(f"price:{item_id}", price, ex=self.ttl)
+                    await pipe.execute()
+            except Exception as e:
+                pass
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "redis_hits": self.redis_hits, "misses": self.misses}
+
+
+price_cache = PriceCache(max_size=int(os.environ.get('PRICE_CACHE_SIZE', '100000')),
+                         ttl=float(os.environ.get('PRICE_CACHE_TTL', '300')),
+                         redis_url=os.environ.get('PRICE_CACHE_REDIS_URL'))
@@ -0,0 +1,68 @@
+import os
+
+from bson import ObjectId
+
+from common.idempotency import HIDE_APPLIED_KEYS
+
+# 'celery' sends reads through the brokers like writes, 'direct' queries the service databases
+# from the gateway with a pooled async client, which saves the two broker hops of a lookup
+READ_MODE = os.environ.get('GATEWAY_READ_MODE', 'celery')
+DB_POOL_SIZE = int(os.environ.get('GATEWAY_DB_POOL_SIZE', '100'))
+
+
+def _object_id(value):
+    return ObjectId(value) if ObjectId.is_valid(value) else None
+
+
+class DirectReads():
+    """Read-only access of the gateway to the order, stock and payment databases. Returns the same
+    documents as the find tasks of the services, or None when they do not exist."""
+
+    def __init__(self, order_url, stock_url, payment_url):
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        self.clients = [AsyncIOMotorClient(url, maxPoolSize=DB_POOL_SIZE) for url in (order_url, stock_url, payment_url)]
+        self.orders = self.clients[0]["wdm"]["orders"]
+        self.stock = self.clients[1]["wdm"]["stock"]
+        self.stock_shards = self.clients[1]["wdm"]["stock_shards"]
+        self.payments = self.clients[2]["wdm"]["payments"]
+
+    async def _find(self, collection, document_id):
+        object_id = _object_id(document_id)
+        if object_id is None:
+            return None
+        document = await collection.find_one({"_id": object_id}, HIDE_APPLIED_KEYS)
+        if document:
+            document["_id"] = str(document["_id"])
+        return document
+
+    async def _find_many(self, collection, document_ids):
+        object_ids = [object_id for object_id in map(_object_id, document_ids) if object_id is not None]
+        documents = {}
+        async for document in collection.find({"_id": {"$in": object_ids}}, HIDE_APPLIED_KEYS):
+            document["_id"] = str(document["_id"])
+            documents[document["_id"]] = document
+        return documents
+
+    async def find_order(self, order_id):
+        return await self._find(self.orders, order_id)
+
+    async def find_users(self, user_ids):
+        return await self._find_many(self.payments, user_ids)
+
+    async def find_items(self, item_ids, full=False):
+        if not full:
+            object_ids = [object_id for object_id in map(_object_id, item_ids) if object_id is not None]
+            return {str(item["_id"]): item["price"] async for item in self.stock.find({"_id": {"$in": object_ids}}, {"price": 1})}
+        items = await self._find_many(self.stock, item_ids)
+        # The stock of a sharded item is the sum of its shards and of what is left in the item itself
+        sharded = [item_id for item_id, item in items.items() if item.get("shards")]
+        if sharded:
+            async for shard in self.stock_shards.find({"item_id": {"$in": sharded}}, {"item_id": 1, "stock": 1}):
+                items[shard["item_id"]]["stock"] += shard["stock"]
+        return items
+
+
+direct_reads = None
+if READ_MODE == 'direct':
+    direct_reads = DirectReads(os.environ['ORDER_DB_URL'], os.environ['STOCK_DB_URL'], os.environ['PAYMENT_DB_URL'])
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from celery.exceptions import TimeoutError as TaskTimeoutError
+
+from common.celery_config import READ_TASKS
+from common.metrics import gauge, histogram
+from .admission import DeadlineExceeded, Overloaded, remaining
+
+# Celery's AsyncResult.get() blocks, so waiting on it inside a route handler stalls the
+# whole event loop. Signatures are sent and awaited on a dedicated thread pool instead.
+# Both the send and the wait happen on the same pool thread: the app backend (and with
+# rpc:// its reply queue) is thread-local, so the result must be consumed where it was sent.
+# Calls run in a copy of the caller's context, so that the trace of the request reaches the task headers.
+RESULT_THREADS = int(os.environ.get('GATEWAY_RESULT_THREADS', '128'))
+
+executor = ThreadPoolExecutor(max_workers=RESULT_THREADS, thread_name_prefix='celery-result')
+
+task_seconds = histogram('gateway_task_seconds',
+                         'Time from sending a task to receiving its result (round_trip), and from the worker '
+                         'storing the result to receiving it (result_return, only for backends that record it)',
+                         ('task', 'phase'))
+tasks_in_flight = gauge('gateway_tasks_in_flight', 'Tasks sent and waiting for their result', ('task',))
+
+
+def _result_return(task):
+    """Seconds since the worker stored the result, from the date_done the redis backend records."""
+    try:
+        date_done = task.date_done
+    except Exception as e:
+        return None
+    if isinstance(date_done, str):
+        date_done = datetime.fromisoformat(date_done)
+    if not isinstance(date_done, datetime):
+        return None
+    if date_done.tzinfo is None:
+        date_done = date_done.replace(tzinfo=timezone.utc)
+    return max(time.time() - date_done.timestamp(), 0.0)
+
+
+def _is_read(name):
+    return name.rsplit('.', 1)[-1] in READ_TASKS
+
+
+def _deadline_exceeded(name):
+    """Lookups can be retried right away (503), a write that ran out of time may still be applied (504)."""
+    if _is_read(name):
+        return Overloaded("Request deadline exceeded")
+    return DeadlineExceeded("Request deadline exceeded")
+
+
+def _deadline_options(name, timeout):
+    """Timeout and task options bounding a task by the deadline of the current request, if any."""
+    left = remaining()
+    if left is None:
+        return timeout, {}, False
+    if left <= 0:
+        raise _deadline_exceeded(name)
+    # Workers drop tasks that are still queued when nobody waits for them anymore. Lookups are also
+    # stopped when they run past the deadline, writes are left to finish.
+    options = {'expires': left}
+    if _is_read(name):
+        options['time_limit'] = max(left, 1)
+    if timeout is None or left < timeout:
+        return left, options, True
+    return timeout, options, False
+
+
+def _apply(signature, timeout):
+    name = getattr(signature, 'task', None) or 'group'
+    timeout, options, bounded_by_deadline = _deadline_options(name, timeout)
+    tasks_in_flight.inc(name)
+    before = time.perf_counter()
+    try:
+        task = signature.apply_async(**options)
+        result = task.get(timeout=timeout)
+    except TaskTimeoutError:
+        if bounded_by_deadline:
+            raise _deadline_exceeded(name)
+        raise
+    finally:
+        tasks_in_flight.dec(name)
+    task_seconds.observe(time.perf_counter() - before, name, 'round_trip')
+    result_return = _result_return(task)
+    if result_return is not None:
+        task_seconds.observe(result_return, name, 'result_return')
+    return task, result
+
+
+async def run(signature, timeout=None):
+    """Send a signature (task or group) and await its result without blocking the event loop.
+    Returns a (AsyncResult, value) tuple, raising like AsyncResult.get() on task errors.
+    Within a request, the wait and the task are bounded by the request deadline (raising Overloaded for
+    lookups and DeadlineExceeded for writes)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, contextvars.copy_context().run, _apply, signature, timeout)
+
+
+async def in_thread(function, *args):
+    """Run a blocking call (e.g. a pymongo query) on the same pool, without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, contextvars.copy_context().run, function, *args)
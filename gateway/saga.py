@@ -1,8 +1,25 @@
 from enum import Enum
+from uuid import uuid4
 
-from celery import group
-from inspect import iscoroutinefunction
 import asyncio
+import logging
+import os
+
+from celery.exceptions import TimeoutError as TaskTimeoutError
+
+from common import tracing
+from .results import run
+
+logger = logging.getLogger(__name__)
+
+# Time a single step may take before its outcome is considered unknown
+STEP_TIMEOUT = float(os.environ.get('SAGA_STEP_TIMEOUT', '30'))
+# Unfinished sagas that were not updated for this long are assumed to be orphaned by a crashed gateway
+RECOVERY_AFTER = float(os.environ.get('SAGA_RECOVERY_AFTER', '300'))
+RECOVERY_INTERVAL = float(os.environ.get('SAGA_RECOVERY_INTERVAL', '60'))
+# Failed compensations are retried with exponential backoff starting at COMPENSATION_BACKOFF seconds
+COMPENSATION_RETRIES = int(os.environ.get('SAGA_COMPENSATION_RETRIES', '3'))
+COMPENSATION_BACKOFF = float(os.environ.get('SAGA_COMPENSATION_BACKOFF', '0.5'))
 
 
 class State(Enum):
@@ -12,70 +29,176 @@ class State(Enum):
     CREATED = 3
     RUNNING = 4
     COMPENSATION_FAILURE = 5
+    TIMEOUT = 6
+
+
+# Steps in these states may have been applied and must be compensated when the saga fails.
+# Compensating an action that never ran is a no-op thanks to its idempotency key.
+MAYBE_APPLIED = (State.SUCCESS, State.RUNNING, State.TIMEOUT)
+# Steps to compensate, including those whose compensation failed before, e.g. while their action was still running
+UNCOMPENSATED = MAYBE_APPLIED + (State.COMPENSATION_FAILURE,)
 
 
 class Step():
     """
-    Saga step with action and compensation functions.
-    These functions must return true if the execution was successful, false otherwise.
+    Saga step with action and compensation signatures of a task of the given service.
+    The tasks must return a truthy value if the execution was successful, a falsy one otherwise.
+    Actions must accept an idempotency_key and compensations an action_key and an idempotency_key.
+    Steps of the same group run concurrently, groups run one after the other in ascending order.
     """
 
-    def __init__(self, name, action, compensation):
+    def __init__(self, name, action, compensation, service, group=0):
         self.name = name
         self.state = State.CREATED
 
         self.action = action
         self.compensation = compensation
+        self.service = service
+        self.group = group
         super().__init__()
 
     @staticmethod
-    def create(name, action, compensation):
+    def create(name, action, compensation, service, group=0):
         if not callable(action) or not callable(compensation):
             return None
-        return Step(name, action, compensation)
+        return Step(name, action, compensation, service, group)
 
 
 class Saga():
-    """Saga class that runs a list of steps. If a step fails, the steps that succeded are reverted using the compensation function."""
+    """
+    Saga class that runs its steps group by group, the steps of a group concurrently. If a step fails,
+    the following groups are not started and the steps that may have been applied are reverted using
+    their compensation, last group first. Every transition is written to the saga log (if any),
+    so that a saga interrupted by a crash can be finished by recover().
+    """
 
-    def __init__(self):
+    def __init__(self, log=None, timeout=STEP_TIMEOUT):
+        self.id = uuid4().hex
         self.state = State.CREATED
         self.steps = []
+        self.log = log
+        self.timeout = timeout
 
-    def add_step(self, name, action, compensation):
-        step = Step.create(name, action, compensation)
+    def add_step(self, name, action, compensation, service, group=0):
+        step = Step.create(name, action, compensation, service, group)
         if step is None:
             raise ValueError("Could not parse arguments into valid step type")
+        # Redelivered or retried tasks are applied once, and a compensation only undoes its action if it was applied
+        key = f"{self.id}:{len(self.steps)}"
+        step.action = action.clone(kwargs={"idempotency_key": key})
+        step.compensation = compensation.clone(kwargs={"action_key": key, "idempotency_key": f"{key}:undo"})
         self.steps.append(step)
 
-    def run(self, *args, executor=None, **kwargs):
+    async def _save(self):
+        if self.log is not None:
+            await self.log.update(self)
+
+    async def _run_step(self, step):
+        with tracing.span(f"saga step {step.name}", saga=self.id):
+            try:
+                task, result = await run(step.action, timeout=self.timeout)
+                step.state = State.SUCCESS if result and not task.failed() else State.FAILURE
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A step that timed out may still be applied later by its worker
+                step.state = State.TIMEOUT if isinstance(e, TaskTimeoutError) else State.FAILURE
+
+    def groups(self):
+        """Steps grouped by group, in execution order."""
+        groups = {}
+        for step in self.steps:
+            groups.setdefault(step.group, []).append(step)
+        return [groups[group] for group in sorted(groups)]
+
+    async def _compensate_step(self, step):
+        for attempt in range(COMPENSATION_RETRIES + 1):
+            if attempt > 0:
+                await asyncio.sleep(COMPENSATION_BACKOFF * 2 ** (attempt - 1))
+            try:
+                with tracing.span(f"saga compensation {step.name}", saga=self.id, attempt=attempt):
+                    task, result = await run(step.compensation, timeout=self.timeout)
+                if result and not task.failed():
+                    step.state = State.COMPENSATED
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                pass
+        step.state = State.COMPENSATION_FAILURE
+
+    async def compensate(self):
+        """Revert the steps that may have been applied, last group first, and finish the saga."""
+        for steps in reversed(self.groups()):
+            await asyncio.gather(*[self._compensate_step(step) for step in steps if step.state in UNCOMPENSATED])
+        if any(step.state == State.COMPENSATION_FAILURE for step in self.steps):
+            self.state = State.COMPENSATION_FAILURE
+        else:
+            self.state = State.FAILURE
+        await self._save()
+        return self.state
+
+    async def run(self):
         """Run the saga"""
         self.state = State.RUNNING
-        
-        stock_task = group([step.action for step in self.steps if "Decrease" in step.name]).delay()
-        payment_task = group([step.action for step in self.steps if "Payment" in step.name]).delay()
-        stock_results = stock_task.get()
-        payment_results = payment_task.get()
-
-        if all(stock_results) and all(payment_results):
-            self.state = State.SUCCESS
-            for step in self.steps:
-                step.state = State.SUCCESS
-            return self.state
+        for index, steps in enumerate(self.groups()):
+            # A group is logged as running before its actions are sent, so a crash leaves it compensable
+            for step in steps:
+                step.state = State.RUNNING
+            if index == 0 and self.log is not None:
+                await self.log.start(self)
+            elif index > 0:
+                await self._save()
+            await asyncio.gather(*[self._run_step(step) for step in steps])
+            if not all(step.state == State.SUCCESS for step in steps):
+                break
         else:
-            self.state = State.FAILURE
-            for i,action in enumerate(stock_results):
-                if not action:
-                    self.steps[i].state = State.FAILURE
-                else:
-                    self.steps[i].state = State.SUCCESS
-            
-            compensation_task = group([step.compensation for step in self.steps if step.state == State.SUCCESS]).delay()
-
-            if not payment_results[0]:
-                self.steps[-1].state = State.FAILURE
-            else:
-                self.steps[-1].compensation.delay()
+            self.state = State.SUCCESS
+            await self._save()
             return self.state
 
-        
+        # Log the outcome of the actions before compensating
+        await self._save()
+        return await self.compensate()
+
+    @staticmethod
+    def from_log(document, apps, log=None):
+        """Rebuild a saga from its log document. apps maps the service of each step to its Celery app."""
+        saga = Saga(log=log)
+        saga.id = document["_id"]
+        saga.state = State[document["state"]]
+        for entry in document["steps"]:
+            app = apps[entry["service"]]
+            step = Step(entry["name"], app.signature(entry["action"]), app.signature(entry["compensation"]),
+                        entry["service"], entry["group"])
+            step.state = State[entry["state"]]
+            saga.steps.append(step)
+        return saga
+
+
+async def recover(log, apps, stale_after=RECOVERY_AFTER):
+    """Finish the sagas orphaned by crashed gateways: sagas whose steps all succeeded are marked
+    successful, all others are compensated. Sagas whose compensation failed are compensated again."""
+    while True:
+        document = await log.claim_stale([State.CREATED.name, State.RUNNING.name, State.COMPENSATION_FAILURE.name],
+                                         stale_after)
+        if document is None:
+            return
+        saga = Saga.from_log(document, apps, log=log)
+        if saga.steps and all(step.state == State.SUCCESS for step in saga.steps):
+            saga.state = State.SUCCESS
+            await saga._save()
+        else:
+            await saga.compensate()
+
+
+async def recover_periodically(log, apps, interval=RECOVERY_INTERVAL):
+    while True:
+        try:
+            await log.create_indexes()
+            await recover(log, apps)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Saga recovery failed")
+        await asyncio.sleep(interval)
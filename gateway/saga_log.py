@@ -0,0 +1,48 @@
+import os
+import socket
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, MongoClient, ReturnDocument
+
+from .results import in_thread
+
+
+class SagaLog():
+    """
+    Durable log of saga transitions in Mongo, so that sagas interrupted by a gateway crash can be
+    finished by another gateway worker. A saga document holds the saga state, the owning worker and,
+    for every step, its action and compensation signatures and its state.
+    """
+
+    def __init__(self, url):
+        self.client = MongoClient(url)
+        self.sagas = self.client["wdm"]["sagas"]
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def create_indexes(self):
+        await in_thread(self.sagas.create_index, [("state", ASCENDING), ("updated_at", ASCENDING)])
+
+    async def start(self, saga):
+        document = {
+            "_id": saga.id,
+            "state": saga.state.name,
+            "owner": self.owner,
+            "updated_at": datetime.utcnow(),
+            "steps": [{"name": step.name, "service": step.service, "group": step.group, "action": dict(step.action),
+                       "compensation": dict(step.compensation), "state": step.state.name} for step in saga.steps],
+        }
+        await in_thread(self.sagas.insert_one, document)
+
+    async def update(self, saga):
+        """Write the current state of the saga and of all of its steps."""
+        update = {"state": saga.state.name, "updated_at": datetime.utcnow()}
+        for index, step in enumerate(saga.steps):
+            update[f"steps.{index}.state"] = step.state.name
+        await in_thread(self.sagas.update_one, {"_id": saga.id}, {"$set": update})
+
+    async def claim_stale(self, states, stale_after):
+        """Take over one unfinished saga that was not updated for stale_after seconds, or return None."""
+        return await in_thread(lambda: self.sagas.find_one_and_update(
+            {"state": {"$in": states}, "updated_at": {"$lt": datetime.utcnow() - timedelta(seconds=stale_after)}},
+            {"$set": {"owner": self.owner, "updated_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER))
@@ -1,51 +1,49 @@
-import atexit
 import os
 import sys
 
 from bson import ObjectId
-from pymongo import MongoClient
 from celery import Celery
 
-class CeleryConfig:
-    # Celery configuration
-    # http://docs.celeryproject.org/en/latest/configuration.html
-
-    broker_url = os.environ.get('ORDER_BROKER_URL', '')
-    result_backend = 'rpc://'
-
-    # json serializer is more secure than the default pickle
-    task_serializer = 'json'
-    result_serializer = 'json'
-    accept_content = ['json']
-
-    # Use UTC instead of localtime
-    enable_utc = True
+from common.celery_config import celery_config
+from common.idempotency import HIDE_APPLIED_KEYS, create_indexes, keyed_update, run_once, unapplying, undo_once, was_applied
+from common.metrics import serve_worker_metrics
+from common.mongo import connect, connect_per_process, set_up
+from common.tracing import trace_worker_tasks
 
 app = Celery()
-app.config_from_object(CeleryConfig)
+app.config_from_object(celery_config('order'))
 
 IN_CELERY_WORKER_PROCESS = sys.argv and sys.argv[0].endswith('celery')\
     and 'worker' in sys.argv
 
-if IN_CELERY_WORKER_PROCESS:
-    print ('Im in Celery worker')
-    mongo_url = os.environ['DB_URL']
 
-    client = MongoClient(mongo_url)
+def connect_db(concurrency=None):
+    global client, orders, operations
+    client = connect(os.environ['DB_URL'], concurrency)
     db = client["wdm"]
     orders = db["orders"]
+    # Idempotency keys of the applied mutations, so that redelivered tasks are not applied twice
+    operations = db["operations"]
+
+    set_up(_create_indexes)
 
 
-    def close_db_connection():
-        client.close()
+def _create_indexes():
+    create_indexes(operations)
 
 
-    atexit.register(close_db_connection)
+if IN_CELERY_WORKER_PROCESS:
+    print ('Im in Celery worker')
+    # Every process running tasks opens its own client, after the fork with the prefork pool
+    connect_per_process(connect_db)
+    serve_worker_metrics()
+    trace_worker_tasks('order')
 
 
 @app.task
 def create_order(user_id):
-    order = {"user_id": user_id, "items": [], "paid": False}
+    # Items are stored as {item_id: quantity} lines
+    order = {"user_id": user_id, "items": {}, "prices": {}, "total_cost": 0, "paid": False}
     inserted_id = orders.insert_one(order).inserted_id
     return {"order_id": str(inserted_id)}
 
@@ -60,27 +58,42 @@ def remove_order(order_id):
 
 
 @app.task
-def add_item(order_id, item_id):
-    result = orders.update_one({"_id": ObjectId(order_id)}, {
-                               "$addToSet": {"items": item_id}})
-    if result.matched_count > 0:
-        return {"success": True}
-    else:
-        return None
+def add_item(order_id, item_id, price, quantity=1, idempotency_key=None):
+    # The running total and the line price are kept in the same write as the line itself
+    price = int(price)
+    quantity = int(quantity)
+
+    def apply(key):
+        result = keyed_update(orders, {"_id": ObjectId(order_id)}, {
+                              "$inc": {f"items.{item_id}": quantity, "total_cost": price * quantity},
+                              "$set": {f"prices.{item_id}": price}}, key)
+        if result.matched_count > 0 or was_applied(orders, {"_id": ObjectId(order_id)}, key):
+            return {"success": True}
+        else:
+            return None
+
+    return run_once(operations, "add_item", [order_id, item_id, price, quantity], idempotency_key, apply)
 
 
 @app.task
-def remove_item(order_id, item_id):
-    result = orders.update_one({"_id": ObjectId(order_id)}, {
-                               "$pull": {"items": item_id}})
-    if result.matched_count > 0:
-        return {"success": True}
-    else:
-        return None
+def remove_item(order_id, item_id, idempotency_key=None):
+    def apply(key):
+        # Pipeline update so one unit is removed at the price stored for the line, dropping empty lines, in one write
+        result = keyed_update(orders, {"_id": ObjectId(order_id), f"items.{item_id}": {"$gte": 1}}, [
+            {"$set": {"total_cost": {"$subtract": ["$total_cost", f"$prices.{item_id}"]},
+                      f"items.{item_id}": {"$subtract": [f"$items.{item_id}", 1]}}},
+            {"$set": {"items": {"$arrayToObject": {"$filter": {
+                "input": {"$objectToArray": "$items"}, "cond": {"$gt": ["$$this.v", 0]}}}}}}], key)
+        if result.matched_count > 0 or was_applied(orders, {"_id": ObjectId(order_id)}, key) or orders.count_documents({"_id": ObjectId(order_id)}, limit=1) > 0:
+            return {"success": True}
+        else:
+            return None
+
+    return run_once(operations, "remove_item", [order_id, item_id], idempotency_key, apply)
     
 @app.task
 def find_order(order_id):
-    order = orders.find_one({"_id": ObjectId(order_id)})
+    order = orders.find_one({"_id": ObjectId(order_id)}, HIDE_APPLIED_KEYS)
     if order:
         order["_id"] = str(order["_id"])
         return order
@@ -88,6 +101,36 @@ def find_order(order_id):
         return None
 
 
+@app.task
+def mark_paid(order_id, idempotency_key=None):
+    """Last step of a checkout. Fails if the order was already paid, so that a concurrent checkout is undone."""
+    def apply(key):
+        result = keyed_update(orders, {"_id": ObjectId(order_id), "paid": False}, {"$set": {"paid": True}}, key)
+        if result.modified_count > 0 or was_applied(orders, {"_id": ObjectId(order_id)}, key):
+            return {"success": True}
+        else:
+            return None
+
+    return run_once(operations, "mark_paid", [order_id], idempotency_key, apply)
+
+
+@app.task
+def mark_unpaid(order_id, action_key=None, idempotency_key=None):
+    def apply(key, paid_key):
+        if paid_key is None:
+            result = orders.update_one({"_id": ObjectId(order_id)}, {"$set": {"paid": False}})
+        else:
+            # Abandoned mark_paid, the order was only marked paid by it if it carries its key
+            result = orders.update_one({"_id": ObjectId(order_id), "applied_keys": paid_key},
+                                       unapplying({"$set": {"paid": False}}, paid_key))
+        if result.matched_count > 0 or paid_key is not None:
+            return {"success": True}
+        else:
+            return None
+
+    return undo_once(operations, "mark_paid", action_key, "mark_unpaid", [order_id], idempotency_key, apply)
+
+
 # @app.get('/find/{order_id}', status_code=status.HTTP_200_OK)
 # def find_order(order_id):
 #     order = orders.find_one({"_id": ObjectId(order_id)})
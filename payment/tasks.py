@@ -1,46 +1,94 @@
-import atexit
 import os
 import sys
+from contextlib import contextmanager
 
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from celery import Celery
 
-class CeleryConfig:
-    # Celery configuration
-    # http://docs.celeryproject.org/en/latest/configuration.html
-
-    broker_url = os.environ.get('PAYMENT_BROKER_URL', '')
-    result_backend = 'rpc://'
-
-    # json serializer is more secure than the default pickle
-    task_serializer = 'json'
-    result_serializer = 'json'
-    accept_content = ['json']
-
-    # Use UTC instead of localtime
-    enable_utc = True
+from common.celery_config import celery_config
+from common.idempotency import HIDE_APPLIED_KEYS, create_indexes, keyed_update, run_once, unapplying, undo_once, was_applied
+from common.metrics import serve_worker_metrics
+from common.mongo import connect, connect_per_process, set_up, supports_transactions
+from common.tracing import trace_worker_tasks
 
 app = Celery()
-app.config_from_object(CeleryConfig)
+app.config_from_object(celery_config('payment'))
 
 IN_CELERY_WORKER_PROCESS = sys.argv and sys.argv[0].endswith('celery')\
     and 'worker' in sys.argv
 
-if IN_CELERY_WORKER_PROCESS:
-    print ('Im in Celery worker')
-    mongo_url = os.environ['DB_URL']
 
-    client = MongoClient(mongo_url)
+# States of a ledger entry: pending while the credit is taken, paid once it is, refunding while it is given back.
+# Entries written before states existed are migrated to paid.
+PENDING = "pending"
+PAID = "paid"
+REFUNDING = "refunding"
+
+LEDGER_STATE_INDEX = [("user_id", ASCENDING), ("order_id", ASCENDING), ("state", ASCENDING)]
+
+
+def connect_db(concurrency=None):
+    global client, payments, paid_orders, operations
+    client = connect(os.environ['DB_URL'], concurrency)
     db = client["wdm"]
     payments = db["payments"]
+    # Ledger of paid orders, one document per (user, order) instead of a growing array in the user document
+    paid_orders = db["paid_orders"]
+    # Idempotency keys of the applied mutations, so that redelivered tasks are not applied twice
+    operations = db["operations"]
+
+    set_up(_create_indexes)
+    set_up(_migrate_paid_orders)
+
+
+def _create_indexes():
+    paid_orders.create_index([("user_id", ASCENDING), ("order_id", ASCENDING)], unique=True)
+    # Covers payment_status and payment_statuses, the unique index above leaves the state out
+    paid_orders.create_index(LEDGER_STATE_INDEX)
+    create_indexes(operations)
+
+
+def _migrate_paid_orders():
+    """Move the paid_orders arrays that user documents had before the ledger into it, and mark the entries
+    written before the ledger had states as paid. Their amount is unknown, a refund of those orders gives
+    back the amount it is called with."""
+    for user in payments.find({"paid_orders.0": {"$exists": True}}, {"paid_orders": 1}):
+        user_id = str(user["_id"])
+        try:
+            paid_orders.insert_many([{"user_id": user_id, "order_id": order_id, "state": PAID}
+                                     for order_id in user["paid_orders"]], ordered=False)
+        except BulkWriteError:
+            # Already moved by another worker
+            pass
+        payments.update_one({"_id": user["_id"]}, {"$pull": {"paid_orders": {"$in": user["paid_orders"]}}})
+    paid_orders.update_many({"state": {"$exists": False}}, {"$set": {"state": PAID}})
+
+
+@contextmanager
+def _atomically():
+    """Session of a transaction for the writes of a refund where the database supports them, else None:
+    the ledger states then let a retry under the same key finish what a crashed attempt started."""
+    if not supports_transactions(client):
+        yield None
+        return
+    with client.start_session() as session:
+        with session.start_transaction():
+            yield session
 
 
-    def close_db_connection():
-        client.close()
+if IN_CELERY_WORKER_PROCESS:
+    print ('Im in Celery worker')
+    # Every process running tasks opens its own client, after the fork with the prefork pool
+    connect_per_process(connect_db)
+    serve_worker_metrics()
+    trace_worker_tasks('payment')
 
 
-    atexit.register(close_db_connection)
+def _applied(user_id, key, session=None):
+    """Whether the operation under key was already applied to the user, by an earlier attempt."""
+    return was_applied(payments, {"_id": ObjectId(user_id)}, key, session)
 
 
 @app.task
@@ -50,9 +98,16 @@ def create_user():
     return {"user_id": str(inserted_id)}
 
 
+@app.task
+def create_users(n: int, credit: int):
+    """Create n users with the given credit in one write, for seeding. Returns their ids."""
+    result = payments.insert_many([{"credit": int(credit)} for _ in range(int(n))], ordered=False)
+    return {"user_ids": [str(inserted_id) for inserted_id in result.inserted_ids]}
+
+
 @app.task
 def find_user(user_id: str):
-    user = payments.find_one({"_id": ObjectId(user_id)})
+    user = payments.find_one({"_id": ObjectId(user_id)}, HIDE_APPLIED_KEYS)
     if user:
         user["_id"] = str(user["_id"])
         return user
@@ -61,46 +116,136 @@ def find_user(user_id: str):
 
 
 @app.task
-def add_credit(user_id: str, amount: int):
-    amount = int(amount)
-    result = payments.update_one({"_id": ObjectId(user_id)}, {
-                                 "$inc": {"credit": amount}})
-    if result.matched_count > 0:
-        return {"success": True}
-    else:
+def find_users(user_ids: list):
+    """Look up several users in one query. Returns a dict of user id -> user, unknown or malformed ids are left out."""
+    try:
+        object_ids = [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+        users = {}
+        for user in payments.find({"_id": {"$in": object_ids}}, HIDE_APPLIED_KEYS):
+            user["_id"] = str(user["_id"])
+            users[user["_id"]] = user
+        return users
+    except Exception as e:
         return None
 
 
 @app.task
-def remove_credit(user_id: str, order_id: str, amount: int):
+def add_credit(user_id: str, amount: int, idempotency_key: str = None):
     amount = int(amount)
-    result = payments.update_one({"_id": ObjectId(user_id), "credit": {
-                                 "$gte": amount}}, {"$inc": {"credit": -amount}})
-    if result.matched_count > 0:
-        payments.update_one({"_id": ObjectId(user_id)}, {
-                            "$addToSet": {"paid_orders": order_id}})
-        return {"success": True}
-    else:
-        return None
+
+    def apply(key):
+        result = keyed_update(payments, {"_id": ObjectId(user_id)}, {"$inc": {"credit": amount}}, key)
+        if result.matched_count > 0 or _applied(user_id, key):
+            return {"success": True}
+        else:
+            return None
+
+    return run_once(operations, "add_credit", [user_id, amount], idempotency_key, apply)
 
 
 @app.task
-def cancel_payment(user_id: str, order_id: str, amount: int):
-    user = payments.find_one(
-        {"_id": ObjectId(user_id), "paid_orders": order_id})
-    if user:
-        amount = int(amount)
-        result = payments.update_one({"_id": ObjectId(user_id)}, {
-                                     "$inc": {"credit": amount}, "$pull": {"paid_orders": order_id}})
-        return {"success": True}
-    else:
-        return None
+def remove_credit(user_id: str, order_id: str, amount: int, idempotency_key: str = None):
+    amount = int(amount)
+
+    def charge(entry, key):
+        """Take the credit of a pending ledger entry, then mark it paid, or drop it if the credit falls short."""
+        result = keyed_update(payments, {"_id": ObjectId(user_id), "credit": {"$gte": amount}},
+                              {"$inc": {"credit": -amount}}, key)
+        if result.matched_count > 0 or _applied(user_id, key):
+            paid_orders.update_one(entry, {"$set": {"state": PAID}})
+            return {"success": True}
+        else:
+            paid_orders.delete_one(entry)
+            return None
+
+    def apply(key):
+        # Inserting the ledger entry first makes the unique index reject a second payment of the same order,
+        # the entry is only read when it already exists
+        entry = {"user_id": user_id, "order_id": order_id, "key": key}
+        try:
+            if not supports_transactions(client):
+                paid_orders.insert_one({**entry, "amount": amount, "state": PENDING})
+                return charge(entry, key)
+            with client.start_session() as session:
+                with session.start_transaction():
+                    # The entry commits with the credit, so it is paid as soon as it exists
+                    paid_orders.insert_one({**entry, "amount": amount, "state": PAID}, session=session)
+                    result = keyed_update(payments, {"_id": ObjectId(user_id), "credit": {"$gte": amount}},
+                                          {"$inc": {"credit": -amount}}, key, session)
+                    if result.matched_count == 0:
+                        session.abort_transaction()
+                        return None
+            return {"success": True}
+        except DuplicateKeyError:
+            pass
+        # Paid or being paid already, by an earlier attempt of this payment or by another one
+        claimed = paid_orders.find_one({"user_id": user_id, "order_id": order_id})
+        if claimed is None or key is None or claimed.get("key") != key:
+            return None
+        if claimed.get("state") != PENDING:
+            return {"success": True}
+        return charge(entry, key)
+
+    return run_once(operations, "remove_credit", [user_id, order_id, amount], idempotency_key, apply)
+
+
+@app.task
+def cancel_payment(user_id: str, order_id: str, amount: int, action_key: str = None, idempotency_key: str = None):
+    def apply(key, paid_key):
+        entry = {"user_id": user_id, "order_id": order_id}
+        with _atomically() as session:
+            if paid_key is not None:
+                # Abandoned remove_credit, only what it applied is undone: its ledger entry and the credit carrying its key
+                paid_orders.delete_one({**entry, "key": paid_key}, session=session)
+                payments.update_one({"_id": ObjectId(user_id), "applied_keys": paid_key},
+                                    unapplying({"$inc": {"credit": int(amount)}}, paid_key), session=session)
+                return {"success": True}
+            paid = {**entry, "$or": [{"state": {"$nin": [PENDING, REFUNDING]}}, {"state": REFUNDING, "refund_key": key}]}
+            if session is not None:
+                # The entry is deleted in the transaction giving the credit back
+                payment = paid_orders.find_one_and_delete(paid, session=session)
+            else:
+                # The entry is marked before the credit is given back, so that a retry under the same key finishes the refund
+                payment = paid_orders.find_one_and_update(paid, {"$set": {"state": REFUNDING, "refund_key": key}})
+            if payment is None:
+                return {"success": True} if _applied(user_id, key, session) else None
+            keyed_update(payments, {"_id": ObjectId(user_id)}, {"$inc": {"credit": int(payment.get("amount", amount))}},
+                         key, session)
+            if session is None:
+                paid_orders.delete_one({"_id": payment["_id"]})
+            return {"success": True}
+
+    return undo_once(operations, "remove_credit", action_key, "cancel_payment", [user_id, order_id, int(amount)],
+                     idempotency_key, apply)
+
+
+LEDGER_PROJECTION = {"_id": 0, "user_id": 1, "order_id": 1}
+# An order is paid once its credit was taken, and until it was given back
+IS_PAID = {"state": {"$in": [PAID, REFUNDING]}}
 
 
 @app.task
 def payment_status(user_id: str, order_id: str):
-    user = payments.find_one({"_id": ObjectId(user_id)})
+    if paid_orders.find_one({"user_id": user_id, "order_id": order_id, **IS_PAID}, LEDGER_PROJECTION,
+                            hint=LEDGER_STATE_INDEX):
+        return {"paid": True}
+    user = payments.find_one({"_id": ObjectId(user_id)}, {"_id": 1})
     if user:
-        return {"paid": order_id in user.get("paid_orders", [])}
+        return {"paid": False}
     else:
         return None
+
+
+@app.task
+def payment_statuses(pairs: list):
+    """Bulk payment_status for reconciliation. Takes a list of [user_id, order_id] pairs and returns
+    whether each of them is paid, in the same order. Unknown users are reported as unpaid."""
+    orders_by_user = {}
+    for user_id, order_id in pairs:
+        orders_by_user.setdefault(user_id, []).append(order_id)
+    if not orders_by_user:
+        return []
+    query = {"$or": [{"user_id": user_id, "order_id": {"$in": order_ids}, **IS_PAID}
+                     for user_id, order_ids in orders_by_user.items()]}
+    paid = {(entry["user_id"], entry["order_id"]) for entry in paid_orders.find(query, LEDGER_PROJECTION, hint=LEDGER_STATE_INDEX)}
+    return [(user_id, order_id) in paid for user_id, order_id in pairs]
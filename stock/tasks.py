@@ -1,46 +1,219 @@
-import atexit
 import os
+import random
 import sys
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
 
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import ConfigurationError, OperationFailure
 from celery import Celery
 
-class CeleryConfig:
-    # Celery configuration
-    # http://docs.celeryproject.org/en/latest/configuration.html
-
-    broker_url = os.environ.get('STOCK_BROKER_URL', '')
-    result_backend = 'rpc://'
-
-    # json serializer is more secure than the default pickle
-    task_serializer = 'json'
-    result_serializer = 'json'
-    accept_content = ['json']
-
-    # Use UTC instead of localtime
-    enable_utc = True
+from common.celery_config import celery_config
+from common.idempotency import (HIDE_APPLIED_KEYS, IDEMPOTENCY_LEASE, applying, changed, create_indexes, keyed_update,
+                                run_once, unapplied, unapplying, undo_once, was_applied)
+from common.metrics import serve_worker_metrics
+from common.mongo import connect, connect_per_process, set_up, supports_transactions
+from common.tracing import trace_worker_tasks
 
 app = Celery()
-app.config_from_object(CeleryConfig)
+app.config_from_object(celery_config('stock'))
 
 IN_CELERY_WORKER_PROCESS = sys.argv and sys.argv[0].endswith('celery')\
     and 'worker' in sys.argv
 
-if IN_CELERY_WORKER_PROCESS:
-    print ('Im in Celery worker')
-    mongo_url = os.environ['DB_URL']
 
-    client = MongoClient(mongo_url)
+def connect_db(concurrency=None):
+    global client, stock, stock_shards, operations
+    client = connect(os.environ['DB_URL'], concurrency)
     db = client["wdm"]
     stock = db["stock"]
+    # Stock of hot items split over several counter documents, see shard_item
+    stock_shards = db["stock_shards"]
+    # Idempotency keys of the applied mutations, so that redelivered tasks are not applied twice
+    operations = db["operations"]
+
+    set_up(_create_indexes)
+
+
+def _create_indexes():
+    stock_shards.create_index([("item_id", ASCENDING)])
+    create_indexes(operations)
+
+
+if IN_CELERY_WORKER_PROCESS:
+    print ('Im in Celery worker')
+    # Every process running tasks opens its own client, after the fork with the prefork pool
+    connect_per_process(connect_db)
+    serve_worker_metrics()
+    trace_worker_tasks('stock')
+
+# Shard count of the items known to be sharded by this process. Sharding an item is permanent, so this never goes stale.
+sharded_items = {}
+# Minimum time between two rebalances of the same item requested by this process
+REBALANCE_INTERVAL = float(os.environ.get('STOCK_REBALANCE_INTERVAL', '1'))
+last_rebalance = {}
+
+
+def _find_sharded(item_ids):
+    """Check which of the items are sharded, remembering them. Returns whether any of them is."""
+    object_ids = [ObjectId(item_id) for item_id in item_ids if item_id not in sharded_items]
+    for item in stock.find({"_id": {"$in": object_ids}, "shards": {"$gt": 0}}, {"shards": 1}):
+        sharded_items[str(item["_id"])] = item["shards"]
+    return any(item_id in sharded_items for item_id in item_ids)
+
+
+def _request_rebalance(item_id):
+    now = time.monotonic()
+    if now - last_rebalance.get(item_id, 0) >= REBALANCE_INTERVAL:
+        last_rebalance[item_id] = now
+        rebalance_item.delay(item_id)
+
+
+def _shard_ids(item_id: str):
+    return [f"{item_id}:{shard}" for shard in range(sharded_items[item_id])]
+
+
+def _move_lease():
+    return datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_LEASE)
+
+
+def _collection(name):
+    return stock if name == stock.name else stock_shards
+
 
+def _without(field, keep):
+    """Pipeline stage keeping the elements of an array field for which keep holds, dropping the field once it is empty."""
+    kept = {"$filter": {"input": {"$ifNull": [f"${field}", []]}, "cond": keep}}
+    return {"$set": {field: {"$cond": [{"$eq": [kept, []]}, "$$REMOVE", kept]}}}
 
-    def close_db_connection():
-        client.close()
 
+def _move(source, target, amount: int):
+    """Move amount of stock from the document source to the document target, both (collection, _id) pairs,
+    if source still has it. Returns whether it did. The stock is taken and given in one transaction, or
+    without transactions the move is recorded in the source with the take, so that _finish_moves gives it
+    to the target if this worker dies in between."""
+    (source_collection, source_id), (target_collection, target_id) = source, target
+    if supports_transactions(client):
+        with client.start_session() as session:
+            with session.start_transaction():
+                taken = source_collection.update_one({"_id": source_id, "stock": {"$gte": amount}},
+                                                     {"$inc": {"stock": -amount}}, session=session)
+                moved = taken.matched_count > 0 and target_collection.update_one(
+                    {"_id": target_id}, {"$inc": {"stock": amount}}, session=session).matched_count > 0
+                if not moved:
+                    session.abort_transaction()
+        return moved
+    move = {"key": uuid4().hex, "to": [target_collection.name, target_id], "amount": amount,
+            "lease_until": _move_lease()}
+    taken = source_collection.update_one({"_id": source_id, "stock": {"$gte": amount}},
+                                         {"$inc": {"stock": -amount}, "$push": {"moves": move}})
+    return taken.matched_count > 0 and _give_moved(source_collection, source_id, move)
 
-    atexit.register(close_db_connection)
+
+def _give_moved(source_collection, source_id, move):
+    """Give the stock of a move recorded in its source to its target, or back to the source if the target
+    does not exist. The target records the key of the move until the source dropped it, so this can be repeated."""
+    key = move["key"]
+    name, target_id = move["to"]
+    target_collection = _collection(name)
+    given = target_collection.update_one({"_id": target_id, "received": {"$ne": key}},
+                                         {"$inc": {"stock": move["amount"]}, "$push": {"received": key}})
+    if given.matched_count == 0 and target_collection.count_documents({"_id": target_id}, limit=1) == 0:
+        source_collection.update_one({"_id": source_id, "moves.key": key}, [
+            {"$set": {"stock": {"$add": ["$stock", move["amount"]]}}}, _without("moves", {"$ne": ["$$this.key", key]})])
+        return False
+    source_collection.update_one({"_id": source_id}, [_without("moves", {"$ne": ["$$this.key", key]})])
+    target_collection.update_one({"_id": target_id}, [_without("received", {"$ne": ["$$this", key]})])
+    return True
+
+
+def _finish_moves(item_id: str):
+    """Finish the moves of stock of an item that were left halfway by a dead worker, see _move."""
+    now = datetime.utcnow()
+    for collection, filter in ((stock, {"_id": ObjectId(item_id)}), (stock_shards, {"item_id": item_id})):
+        for document in collection.find({**filter, "moves.lease_until": {"$lte": now}}, {"moves": 1}):
+            for move in document["moves"]:
+                if move["lease_until"] > now:
+                    continue
+                # Claimed like an expired operation, so that a single worker finishes it
+                claimed = collection.update_one(
+                    {"_id": document["_id"], "moves": {"$elemMatch": {"key": move["key"], "lease_until": move["lease_until"]}}},
+                    {"$set": {"moves.$.lease_until": _move_lease()}})
+                if claimed.modified_count > 0:
+                    _give_moved(collection, document["_id"], move)
+
+
+def _take_from_shards(item_id: str, amount: int, key=None):
+    """Take stock of a sharded item, from a random shard when it has enough so that concurrent reservations
+    hit different documents, else from the shard with the most stock after moving stock of the other documents
+    of the item into it (see _move). Either way a single document takes the stock and records key."""
+    if key is not None and _recorded(item_id, key):
+        return True
+    shard_ids = _shard_ids(item_id)
+    result = keyed_update(stock_shards, {"_id": random.choice(shard_ids), "stock": {"$gte": amount}},
+                          {"$inc": {"stock": -amount}}, key)
+    if result.matched_count > 0:
+        return True
+
+    # The shards are uneven or the stock is running out
+    _request_rebalance(item_id)
+    shards = [((stock_shards, shard["_id"]), shard["stock"]) for shard in stock_shards.find(
+        {"_id": {"$in": shard_ids}, "stock": {"$gt": 0}}, {"stock": 1}).sort("stock", DESCENDING)]
+    # Stock left in the item document itself, e.g. given back by release_items
+    item = stock.find_one({"_id": ObjectId(item_id), "stock": {"$gt": 0}}, {"stock": 1})
+    donors = shards[1:] + ([((stock, item["_id"]), item["stock"])] if item else [])
+    target, available = shards[0] if shards else ((stock_shards, shard_ids[0]), 0)
+    if available + sum(part for _, part in donors) < amount:
+        return False
+    for source, part in donors:
+        if available >= amount:
+            break
+        part = min(part, amount - available)
+        if _move(source, target, part):
+            available += part
+    collection, document_id = target
+    result = keyed_update(collection, {"_id": document_id, "stock": {"$gte": amount}}, {"$inc": {"stock": -amount}}, key)
+    return result.matched_count > 0
+
+
+def _recorded(item_id: str, key):
+    """Whether a document of the item recorded the operation under key, i.e. an earlier attempt applied it."""
+    if was_applied(stock, {"_id": ObjectId(item_id)}, key):
+        return True
+    return item_id in sharded_items and was_applied(stock_shards, {"item_id": item_id}, key)
+
+
+def _take(item_id: str, amount: int, key=None):
+    """Take amount of stock of an item if it has enough, returns whether it did (now or under key before)."""
+    if item_id not in sharded_items:
+        result = keyed_update(stock, {"_id": ObjectId(item_id), "stock": {"$gte": amount}},
+                              {"$inc": {"stock": -amount}}, key)
+        if result.matched_count > 0:
+            return True
+        if not _find_sharded([item_id]):
+            return key is not None and _recorded(item_id, key)
+    return _take_from_shards(item_id, amount, key)
+
+
+def _give(item_id: str, amount: int, key=None):
+    """Add amount of stock to an item, returns whether the item exists."""
+    if item_id in sharded_items:
+        if key is not None and _recorded(item_id, key):
+            return True
+        shard = random.randrange(sharded_items[item_id])
+        result = keyed_update(stock_shards, {"_id": f"{item_id}:{shard}"}, {"$inc": {"stock": amount}}, key)
+    else:
+        result = keyed_update(stock, {"_id": ObjectId(item_id)}, {"$inc": {"stock": amount}}, key)
+    return result.matched_count > 0 or (key is not None and _recorded(item_id, key))
+
+
+def _untake(item_id: str, amount: int, key):
+    """Give back the stock taken under key to the document that recorded it, if any."""
+    undo = unapplying({"$inc": {"stock": amount}}, key)
+    if stock.update_one({"_id": ObjectId(item_id), "applied_keys": key}, undo).matched_count == 0:
+        stock_shards.update_one({"item_id": item_id, "applied_keys": key}, undo)
 
 
 @app.task
@@ -50,12 +223,22 @@ def create_item(price: int):
     return {"item_id": str(inserted_id)}
 
 
+@app.task
+def create_items(items: list):
+    """Create items from a list of {"price", "stock"} dicts in one write, for seeding. Returns their ids."""
+    documents = [{"price": int(item["price"]), "stock": int(item.get("stock", 0))} for item in items]
+    result = stock.insert_many(documents, ordered=False)
+    return {"item_ids": [str(inserted_id) for inserted_id in result.inserted_ids]}
+
+
 @app.task
 def find_item(item_id: str):
     try:
-        item = stock.find_one({"_id": ObjectId(item_id)})
+        item = stock.find_one({"_id": ObjectId(item_id)}, HIDE_APPLIED_KEYS)
         if item:
             item["_id"] = str(item["_id"])
+            if item.get("shards"):
+                item["stock"] += sum(shard["stock"] for shard in stock_shards.find({"item_id": item_id}, {"stock": 1}))
             return item
         else:
             return None
@@ -64,28 +247,209 @@ def find_item(item_id: str):
 
 
 @app.task
-def add_stock(item_id: str, amount: int):
+def find_items(item_ids: list, full: bool = False):
+    """Look up the prices of several items in one query. Returns a dict of item id -> price,
+    unknown or malformed ids are left out. With full, the values are the items like find_item returns them."""
+    try:
+        object_ids = [ObjectId(item_id) for item_id in item_ids if ObjectId.is_valid(item_id)]
+        if not full:
+            items = stock.find({"_id": {"$in": object_ids}}, {"price": 1})
+            return {str(item["_id"]): item["price"] for item in items}
+        items = {}
+        for item in stock.find({"_id": {"$in": object_ids}}, HIDE_APPLIED_KEYS):
+            item["_id"] = str(item["_id"])
+            items[item["_id"]] = item
+        sharded = [item_id for item_id, item in items.items() if item.get("shards")]
+        if sharded:
+            for shard in stock_shards.find({"item_id": {"$in": sharded}}, {"item_id": 1, "stock": 1}):
+                items[shard["item_id"]]["stock"] += shard["stock"]
+        return items
+    except Exception as e:
+        return None
+
+
+@app.task
+def add_stock(item_id: str, amount: int, idempotency_key: str = None):
     try:
         amount = int(amount)
-        result = stock.update_one({"_id": ObjectId(item_id)}, {
-                                  "$inc": {"stock": amount}})
-        if result.matched_count > 0:
-            return {"success": True}
-        else:
-            return None
+
+        def apply(key):
+            if _give(item_id, amount, key):
+                return {"success": True}
+            else:
+                return None
+
+        return run_once(operations, "add_stock", [item_id, amount], idempotency_key, apply)
     except Exception as e:
         return None
 
 
 @app.task
-def remove_stock(item_id: str, amount: int):
+def remove_stock(item_id: str, amount: int, idempotency_key: str = None):
     try:
         amount = int(amount)
-        result = stock.update_one({"_id": ObjectId(item_id), "stock": {
-                                  "$gte": amount}}, {"$inc": {"stock": -amount}})
-        if result.matched_count > 0:
-            return {"success": True}
-        else:
+
+        def apply(key):
+            if _take(item_id, amount, key):
+                return {"success": True}
+            else:
+                return None
+
+        return run_once(operations, "remove_stock", [item_id, amount], idempotency_key, apply)
+    except Exception as e:
+        return None
+
+
+def _reserve_in_transaction(lines: dict, key=None):
+    """Decrement every line in one bulk write inside a transaction, aborting if any line falls short."""
+    requests = [UpdateOne(unapplied({"_id": ObjectId(item_id), "stock": {"$gte": amount}}, key),
+                          applying({"$inc": {"stock": -amount}}, key))
+                for item_id, amount in lines.items()]
+    with client.start_session() as session:
+        with session.start_transaction():
+            result = stock.bulk_write(requests, ordered=True, session=session)
+            if result.matched_count < len(requests):
+                session.abort_transaction()
+                # All lines or none carry the key, if they do an earlier attempt committed the reservation
+                if key is None or stock.count_documents({"_id": ObjectId(next(iter(lines))), "applied_keys": key},
+                                                        limit=1) == 0:
+                    return False
+    changed(key, stock, [ObjectId(item_id) for item_id in lines])
+    return True
+
+
+def _reserve_sequentially(lines: dict, key=None):
+    """Decrement line by line, undoing the lines already taken when one of them falls short."""
+    reserved = {}
+    for item_id, amount in lines.items():
+        if not _take(item_id, amount, key):
+            for reserved_id, reserved_amount in reserved.items():
+                if key is None:
+                    _give(reserved_id, reserved_amount)
+                else:
+                    _untake(reserved_id, reserved_amount, key)
+            return False
+        reserved[item_id] = amount
+    return True
+
+
+@app.task
+def reserve_items(lines: dict, idempotency_key: str = None):
+    """Take stock for every {item_id: amount} line of an order, either all lines or none."""
+    try:
+        lines = {item_id: int(amount) for item_id, amount in lines.items()}
+
+        def apply(key):
+            if not lines:
+                return {"success": True}
+            reserved = None
+            # The stock of sharded items is spread over several documents, they are taken line by line
+            if supports_transactions(client) and not any(item_id in sharded_items for item_id in lines):
+                try:
+                    reserved = _reserve_in_transaction(lines, key)
+                except (ConfigurationError, OperationFailure):
+                    reserved = None
+                if reserved is False and _find_sharded(lines):
+                    reserved = None
+            if reserved is None:
+                reserved = _reserve_sequentially(lines, key)
+            if reserved:
+                return {"success": True}
+            else:
+                return None
+
+        return run_once(operations, "reserve_items", [lines], idempotency_key, apply)
+    except Exception as e:
+        return None
+
+
+@app.task
+def release_items(lines: dict, action_key: str = None, idempotency_key: str = None):
+    """Give back the stock taken by reserve_items (under action_key), compensation for a failed checkout."""
+    try:
+        lines = {item_id: int(amount) for item_id, amount in lines.items()}
+
+        def apply(key, reserved_key):
+            if reserved_key is not None:
+                # Abandoned reservation, only the lines it took are given back
+                for item_id, amount in lines.items():
+                    _untake(item_id, amount, reserved_key)
+                return {"success": True}
+            if not lines:
+                return {"success": True}
+            requests = [UpdateOne(unapplied({"_id": ObjectId(item_id)}, key), applying({"$inc": {"stock": amount}}, key))
+                        for item_id, amount in lines.items()]
+            result = stock.bulk_write(requests, ordered=False)
+            if result.matched_count == len(requests) or key is not None and stock.count_documents(
+                    {"_id": {"$in": [ObjectId(item_id) for item_id in lines]}, "applied_keys": key}) == len(requests):
+                changed(key, stock, [ObjectId(item_id) for item_id in lines])
+                return {"success": True}
+            else:
+                return None
+
+        return undo_once(operations, "reserve_items", action_key, "release_items", [lines], idempotency_key, apply)
+    except Exception as e:
+        return None
+
+
+@app.task
+def shard_item(item_id: str, shards: int):
+    """Split the stock of a hot item over several counter documents, so that concurrent reservations of
+    the item do not all wait on the lock of its document. Sharding an item cannot be undone."""
+    try:
+        shards = int(shards)
+        if shards < 1:
             return None
+        # The shard documents are only created once the item is claimed, an item is sharded once
+        result = stock.update_one({"_id": ObjectId(item_id), "shards": {"$in": [None, 0]}}, {"$set": {"shards": shards}})
+        if result.modified_count == 0:
+            return None
+        sharded_items[item_id] = shards
+        _create_shards(item_id, _shard_ids(item_id))
+        rebalance_item(item_id)
+        return {"success": True}
+    except Exception as e:
+        return None
+
+
+def _create_shards(item_id: str, shard_ids):
+    stock_shards.bulk_write([UpdateOne({"_id": shard_id}, {"$setOnInsert": {"item_id": item_id, "stock": 0}}, upsert=True)
+                             for shard_id in shard_ids], ordered=False)
+
+
+@app.task
+def rebalance_item(item_id: str):
+    """Even out the stock of a sharded item over its shards, moving the stock left in the item document and in
+    documents that are not shards of the item as well. Stock is moved from one document to another at a time
+    (see _move), so that it is never missing while the item is rebalanced."""
+    try:
+        if not _find_sharded([item_id]):
+            return None
+        _finish_moves(item_id)
+        shard_ids = _shard_ids(item_id)
+        shards = {shard["_id"]: shard["stock"] for shard in stock_shards.find({"item_id": item_id}, {"stock": 1})}
+        missing = [shard_id for shard_id in shard_ids if shard_id not in shards]
+        if missing:
+            # Left out by a shard_item that did not finish
+            _create_shards(item_id, missing)
+            shards.update((shard_id, 0) for shard_id in missing)
+        item = stock.find_one({"_id": ObjectId(item_id)}, {"stock": 1})
+        target = (item["stock"] + sum(shards.values())) // len(shard_ids)
+
+        # The shards above the target give their excess, the other documents all of their stock
+        donors = [((stock, item["_id"]), item["stock"])]
+        donors += [((stock_shards, shard_id), amount - target if shard_id in shard_ids else amount)
+                   for shard_id, amount in shards.items()]
+        receivers = [[(stock_shards, shard_id), target - shards[shard_id]] for shard_id in shard_ids if shards[shard_id] < target]
+        for source, excess in donors:
+            for receiver in receivers:
+                part = min(excess, receiver[1])
+                if part > 0 and _move(source, receiver[0], part):
+                    receiver[1] -= part
+                    excess -= part
+            # The remainder of the division
+            if excess > 0 and source[1] not in shard_ids:
+                _move(source, (stock_shards, shard_ids[0]), excess)
+        return {"success": True}
     except Exception as e:
         return None
@@ -36,6 +36,26 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_bulk_create(self):
+        # Test /stock/items/create
+        items: dict = tu.create_items([{"price": 3, "stock": 10}, {"price": 7}])
+        self.assertEqual(len(items['item_ids']), 2)
+
+        first_item: dict = tu.find_item(items['item_ids'][0])
+        self.assertEqual(first_item['price'], 3)
+        self.assertEqual(first_item['stock'], 10)
+
+        second_item: dict = tu.find_item(items['item_ids'][1])
+        self.assertEqual(second_item['price'], 7)
+        self.assertEqual(second_item['stock'], 0)
+
+        # Test /payment/create_users/<n>/<credit>
+        users: dict = tu.create_users(3, 20)
+        self.assertEqual(len(users['user_ids']), 3)
+
+        for user_id in users['user_ids']:
+            self.assertEqual(tu.find_user(user_id)['credit'], 20)
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -143,6 +163,136 @@ class TestMicroservices(unittest.TestCase):
         credit: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit, 5)
 
+    def test_checkout_twice(self):
+        user_id: str = tu.create_user()['user_id']
+        add_credit_response = tu.add_credit_to_user(user_id, 20)
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 10)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        order_id: str = tu.create_order(user_id)['order_id']
+        add_item_response = tu.add_item_to_order(order_id, item_id)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+
+        checkout_response = tu.checkout_order(order_id).status_code
+        self.assertTrue(tu.status_code_is_success(checkout_response))
+
+        # Checking out a paid order again succeeds without charging it twice
+        checkout_response = tu.checkout_order(order_id).status_code
+        self.assertTrue(tu.status_code_is_success(checkout_response))
+
+        credit: int = tu.find_user(user_id)['credit']
+        self.assertEqual(credit, 15)
+
+        stock: int = tu.find_item(item_id)['stock']
+        self.assertEqual(stock, 9)
+
+        order: dict = tu.find_order(order_id)
+        self.assertTrue(order['paid'])
+
+    def test_order_quantities(self):
+        user_id: str = tu.create_user()['user_id']
+        add_credit_response = tu.add_credit_to_user(user_id, 50)
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 10)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        # Adding an item twice makes one line with quantity 2
+        for _ in range(2):
+            add_item_response = tu.add_item_to_order(order_id, item_id)
+            self.assertTrue(tu.status_code_is_success(add_item_response))
+
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(order['items'][item_id], 2)
+        self.assertEqual(order['total_cost'], 10)
+
+        # Removing an item removes one unit of the line
+        add_item_response = tu.add_item_to_order(order_id, item_id)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+        remove_item_response = tu.remove_item_from_order(order_id, item_id)
+        self.assertTrue(tu.status_code_is_success(remove_item_response))
+
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(order['items'][item_id], 2)
+        self.assertEqual(order['total_cost'], 10)
+
+        checkout_response = tu.checkout_order(order_id).status_code
+        self.assertTrue(tu.status_code_is_success(checkout_response))
+
+        # The checkout takes the full quantity of the line
+        stock: int = tu.find_item(item_id)['stock']
+        self.assertEqual(stock, 8)
+
+        credit: int = tu.find_user(user_id)['credit']
+        self.assertEqual(credit, 40)
+
+    def test_idempotency_key(self):
+        user_id: str = tu.create_user()['user_id']
+        item_id: str = tu.create_item(5)['item_id']
+
+        # A write replayed with the same Idempotency-Key is applied once
+        for _ in range(2):
+            add_credit_response = tu.add_credit_to_user(user_id, 10, idempotency_key=f"add-funds-{user_id}")
+            self.assertTrue(tu.status_code_is_success(add_credit_response))
+            add_stock_response = tu.add_stock(item_id, 10, idempotency_key=f"add-stock-{item_id}")
+            self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        credit: int = tu.find_user(user_id)['credit']
+        self.assertEqual(credit, 10)
+        stock: int = tu.find_item(item_id)['stock']
+        self.assertEqual(stock, 10)
+
+        # A new key is a new write
+        add_credit_response = tu.add_credit_to_user(user_id, 10, idempotency_key=f"add-funds-{user_id}-2")
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+
+        credit: int = tu.find_user(user_id)['credit']
+        self.assertEqual(credit, 20)
+
+    def test_sharded_item(self):
+        user_id: str = tu.create_user()['user_id']
+        add_credit_response = tu.add_credit_to_user(user_id, 50)
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 20)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        # Sharding moves the stock of the item into its shards, and is done once
+        shard_response = tu.shard_item(item_id, 4)
+        self.assertTrue(tu.status_code_is_success(shard_response))
+        shard_response = tu.shard_item(item_id, 8)
+        self.assertTrue(tu.status_code_is_failure(shard_response))
+
+        item: dict = tu.find_item(item_id)
+        self.assertEqual(item['stock'], 20)
+        self.assertEqual(item['shards'], 4)
+
+        order_id: str = tu.create_order(user_id)['order_id']
+        for _ in range(2):
+            add_item_response = tu.add_item_to_order(order_id, item_id)
+            self.assertTrue(tu.status_code_is_success(add_item_response))
+        checkout_response = tu.checkout_order(order_id).status_code
+        self.assertTrue(tu.status_code_is_success(checkout_response))
+
+        stock: int = tu.find_item(item_id)['stock']
+        self.assertEqual(stock, 18)
+
+        # More than a shard holds is gathered from the others, and rebalances the item
+        subtract_stock_response = tu.subtract_stock(item_id, 12)
+        self.assertTrue(tu.status_code_is_success(subtract_stock_response))
+        over_subtract_stock_response = tu.subtract_stock(item_id, 7)
+        self.assertTrue(tu.status_code_is_failure(over_subtract_stock_response))
+
+        stock: int = tu.find_item(item_id)['stock']
+        self.assertEqual(stock, 6)
+
 
 if __name__ == '__main__':
     unittest.main()
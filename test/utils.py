@@ -10,18 +10,27 @@ def create_item(price: float) -> dict:
     return requests.post(f"{STOCK_URL}/stock/item/create/{price}").json()
 
 
+def create_items(items: list) -> dict:
+    return requests.post(f"{STOCK_URL}/stock/items/create", json=items).json()
+
+
 def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
-def add_stock(item_id: str, amount: int) -> int:
-    return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}").status_code
+def add_stock(item_id: str, amount: int, idempotency_key: str = None) -> int:
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+    return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}", headers=headers).status_code
 
 
 def subtract_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
 
 
+def shard_item(item_id: str, shards: int) -> int:
+    return requests.post(f"{STOCK_URL}/stock/shard/{item_id}/{shards}").status_code
+
+
 ########################################################################################################################
 #   PAYMENT MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -33,12 +42,17 @@ def create_user() -> dict:
     return requests.post(f"{PAYMENT_URL}/payment/create_user").json()
 
 
+def create_users(n: int, credit: int) -> dict:
+    return requests.post(f"{PAYMENT_URL}/payment/create_users/{n}/{credit}").json()
+
+
 def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
 
-def add_credit_to_user(user_id: str, amount: float) -> int:
-    return requests.post(f"{PAYMENT_URL}/payment/add_funds/{user_id}/{amount}").status_code
+def add_credit_to_user(user_id: str, amount: float, idempotency_key: str = None) -> int:
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+    return requests.post(f"{PAYMENT_URL}/payment/add_funds/{user_id}/{amount}", headers=headers).status_code
 
 
 ########################################################################################################################
@@ -52,6 +66,10 @@ def add_item_to_order(order_id: str, item_id: str) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}").status_code
 
 
+def remove_item_from_order(order_id: str, item_id: str) -> int:
+    return requests.delete(f"{ORDER_URL}/orders/removeItem/{order_id}/{item_id}").status_code
+
+
 def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 